@@ -0,0 +1,102 @@
+# vim: set ft=bash :
+# Shared functions for the Gold wrappers.
+
+GOLD_HOST="util-ha-nfs"
+GOLD_CLUSTERS="thomas|michael|young|myriad|kathleen"
+
+# Per-user cache of which cluster this is, shared with cluster_identity.py.
+# Home directories are shared between clusters, so there is a file per host.
+CLUSTER_IDENTITY_CACHE="${CLUSTER_IDENTITY_CACHE_DIR:-$HOME/.cache}/cluster_identity.$(hostname)"
+# Minutes before it is worked out again
+CLUSTER_IDENTITY_TTL=1440
+
+# Print the name this cluster is identified by. Worked out the first time
+# in the same order as cluster_identity.py: the cluster_name file, whereami,
+# the hostname if it names a Gold cluster, then hostname -f. After that
+# it is read from the cache so slow DNS isn't paid for on every command.
+function cluster_nodename() {
+    local nodename=""
+    if [[ -n "$(find "$CLUSTER_IDENTITY_CACHE" -mmin -"$CLUSTER_IDENTITY_TTL" 2>/dev/null)" ]]
+    then
+        # shellcheck source=/dev/null
+        nodename=$(. "$CLUSTER_IDENTITY_CACHE" && echo "$CLUSTER_NODENAME")
+    fi
+    if [[ -z "$nodename" ]]
+    then
+        if [[ -r /opt/sge/default/common/cluster_name ]]
+        then
+          nodename=$(< /opt/sge/default/common/cluster_name)
+        elif ! nodename=$(/shared/ucl/apps/cluster-bin/whereami 2> /dev/null) || [[ -z "$nodename" ]]
+        then
+          nodename=$(hostname | tr '[:upper:]' '[:lower:]')
+          if ! grep -qE "$GOLD_CLUSTERS" <<< "$nodename"
+          then
+            nodename=$(hostname -f | tr '[:upper:]' '[:lower:]')
+          fi
+        fi
+        # the cache is only an optimisation, so don't fail if it can't be written
+        { mkdir -p "$(dirname "$CLUSTER_IDENTITY_CACHE")" \
+          && printf 'CLUSTER_NODENAME=%q\n' "$nodename" > "$CLUSTER_IDENTITY_CACHE.tmp" \
+          && mv "$CLUSTER_IDENTITY_CACHE.tmp" "$CLUSTER_IDENTITY_CACHE"; } 2> /dev/null
+    fi
+    echo "$nodename"
+}
+
+# Make sure we are on a cluster with Gold: check the cluster name once
+# against all the Gold clusters. Takes an optional list of clusters
+# in the same form as GOLD_CLUSTERS.
+function gold_cluster_check() {
+    cluster_nodename | grep -qE "${1:-$GOLD_CLUSTERS}"
+}
+
+# Where the shared ssh connection's socket goes, and how long it stays up
+# after the last command
+GOLD_SSH_CONTROL_PATH="$HOME/.ssh/gold-%r@%h:%p"
+GOLD_SSH_PERSIST=60
+
+# Run a Gold command on the Gold host. Consecutive commands share one
+# ssh connection, which stays up for a minute after the last one.
+# The master connection is started on its own with its output thrown
+# away, so it never holds open the stderr of a caller capturing 2>&1.
+# If the socket directory can't be made, each command connects by itself.
+function gold_ssh() {
+    local control_dir
+    control_dir="$(dirname "$GOLD_SSH_CONTROL_PATH")"
+    if ! [[ -d "$control_dir" ]] && ! mkdir -m 0700 "$control_dir" 2> /dev/null
+    then
+        ssh "$GOLD_HOST" "$@"
+        return
+    fi
+    if ! ssh -o ControlPath="$GOLD_SSH_CONTROL_PATH" -O check "$GOLD_HOST" 2> /dev/null
+    then
+        # if this fails, the command below just connects by itself
+        ssh -o ControlMaster=yes \
+            -o ControlPath="$GOLD_SSH_CONTROL_PATH" \
+            -o ControlPersist="$GOLD_SSH_PERSIST" \
+            -o LogLevel=QUIET \
+            -MNf "$GOLD_HOST" < /dev/null > /dev/null 2>&1
+    fi
+    ssh -o ControlMaster=no \
+        -o ControlPath="$GOLD_SSH_CONTROL_PATH" \
+        "$GOLD_HOST" "$@"
+}
+
+# Shared cache of balances written by goldbalancecache --refresh
+GOLD_BALANCE_CACHE="${GOLD_BALANCE_CACHE:-/shared/ucl/sysops/gold-balance-cache}"
+# Don't answer from a cache older than this many minutes
+GOLD_BALANCE_MAX_AGE=60
+
+# Print the current user's cached balances as pipe-separated lines
+# Id|Name|Amount|Reserved|Available with a header. Fails if there is
+# no cache for this user or the refresher has stopped updating it.
+function gold_cached_balances() {
+    local cachefile="$GOLD_BALANCE_CACHE/$USER"
+    [[ -r "$cachefile" ]] || return 1
+    [[ -n "$(find "$GOLD_BALANCE_CACHE/.updated" -mmin -"$GOLD_BALANCE_MAX_AGE" 2>/dev/null)" ]] || return 1
+    grep -v '^#' "$cachefile"
+}
+
+# When the cached balances were last refreshed
+function gold_balance_asof() {
+    cat "$GOLD_BALANCE_CACHE/.updated"
+}
@@ -2,14 +2,25 @@
 
 import sys
 import argparse
+import datetime
 #import csv
 import pandas
 
 def getargs(argv):
     parser = argparse.ArgumentParser(description="Show allocation usage in given period.")
     parser.add_argument("--input", help="Gold allocations from stdin, input formed from glsalloc --raw", action='store_true')
-    parser.add_argument("-i", "--institute", dest="institute", help="Show Gold total usage for this institute")
-    parser.add_argument("-d", "--date", dest="date", help="Filter by start date of allocation period, in format yyyy-mm-dd")
+    parser.add_argument("-i", "--institute", dest="institute", action='append', help="Show Gold total usage for this institute (can be repeated)")
+    parser.add_argument("-d", "--date", dest="date", action='append', help="Filter by start date of allocation period, in format yyyy-mm-dd (can be repeated, default is all periods)")
+    parser.add_argument("--chunksize", dest="chunksize", type=int, default=100000, help="Number of lines of input to read at a time")
+    parser.add_argument("--from-store", dest="fromstore", help="Use the local Gold snapshot store instead of stdin", action='store_true')
+    parser.add_argument("--store", dest="store", default="~/gold_store", help="Location of the Gold snapshot store")
+    parser.add_argument("--as-of", dest="asof", help="With --from-store, use the latest snapshot taken on or before this date, in format yyyy-mm-dd (default today)")
+    parser.add_argument("--forecast", dest="forecast", choices=["consortium", "institute", "project"], help="With --from-store, forecast usage and exhaustion dates for each consortium, institute or project from the stored history, flagging likely underspend and overspend")
+    parser.add_argument("--consortia", dest="consortia", help="With --forecast consortium, CSV file mapping Institute to Consortium (an institute not in it is its own consortium)")
+    parser.add_argument("--since", dest="since", help="With --forecast, only use snapshots taken on or after this date, in format yyyy-mm-dd")
+    parser.add_argument("--window", dest="window", type=float, default=14, help="With --forecast, fit the usage rate to this many days of snapshots (default 14)")
+    parser.add_argument("--under", dest="under", type=float, default=0.8, help="With --forecast, flag periods projected to use less than this fraction of Deposited (default 0.8)")
+    parser.add_argument("--json", dest="jsonfile", help="Write out JSON to this file in this location")
     parser.add_argument("--csv", dest="csvfile", help="Write out CSV to this file in this location")
     parser.add_argument("--verbose", help="", action='store_true')
     parser.add_argument("--debug", help="", action='store_true')
@@ -25,6 +36,84 @@ def getargs(argv):
 # end getargs
 
 
+# glsalloc --raw columns and the types to read them as.
+# Dates are parsed separately as they include -infinity and infinity.
+DTYPES = {'Id': 'int64',
+          'Account': 'int64',
+          'Projects': 'object',
+          'StartTime': 'object',
+          'EndTime': 'object',
+          'Amount': 'float64',
+          'Deposited': 'float64',
+          'Description': 'object'}
+
+# Read Gold allocations from glsalloc --raw in chunks, with explicit types.
+# Chunking bounds how many rows are parsed at once: each chunk's times are
+# converted and allocations with an infinite StartTime are dropped before
+# the next is read, so the dropped rows are never all in memory together.
+# Projects is made categorical once the chunks are combined.
+def readallocations(stream, chunksize=100000):
+    chunks = []
+    for chunk in pandas.read_csv(stream, sep='|', dtype=DTYPES, chunksize=chunksize):
+        # -infinity and infinity become NaT
+        chunk['StartTime'] = pandas.to_datetime(chunk['StartTime'], errors='coerce')
+        chunk['EndTime'] = pandas.to_datetime(chunk['EndTime'], errors='coerce')
+        chunks.append(chunk[chunk.StartTime.notna()])
+    if len(chunks) == 0:
+        return pandas.DataFrame(columns=list(DTYPES.keys()))
+    dataframe = pandas.concat(chunks, ignore_index=True)
+    dataframe['Projects'] = dataframe['Projects'].astype('category')
+    return dataframe
+
+# Add a categorical Institute column and a flag for _allocation projects.
+# Both are worked out once per distinct project rather than once per row.
+def addinstitutes(dataframe):
+    projects = dataframe['Projects'].cat.categories
+    # We only want the first item in the split
+    institutes = dict(zip(projects, projects.str.split('_', n=1).str[0]))
+    isalloc = dict(zip(projects, projects.str.contains("_allocation")))
+    dataframe['Institute'] = dataframe['Projects'].map(institutes).astype('category')
+    dataframe['IsAllocation'] = dataframe['Projects'].map(isalloc).astype(bool)
+    return dataframe
+
+# Usage for every allocation period and institute in the dataframe, in one groupby.
+# by adds more columns to group on, eg. SnapshotTime for a history of snapshots.
+# We want this output:
+# StartTime  EndTime  Institute  Deposited  Unallocated  Allocated & Unused  Used  % Used
+def usagereport(dataframe, by=None):
+    keys = ['StartTime', 'Institute'] + (by or [])
+    # filter out _allocation projects and everything else separately
+    allocs = dataframe[dataframe.IsAllocation]
+    projects = dataframe[~dataframe.IsAllocation]
+
+    projects = projects.rename(columns={'Amount':'Allocated & Unused'})
+    allocs = allocs.rename(columns={'Amount':'Unallocated'})
+    # sum the unused time for each institute in each period
+    unused = projects.groupby(keys, observed=True)['Allocated & Unused'].sum().reset_index()
+    # merge the columns we want from allocs and unused
+    # need a left outer join to keep allocs with no subprojects
+    result = allocs[['StartTime', 'EndTime', 'Institute', 'Deposited', 'Unallocated'] + (by or [])].merge(unused, on=keys, how='left')
+    # replace NaN with 0
+    result['Allocated & Unused'] = result['Allocated & Unused'].fillna(0)
+    result['Used'] = result['Deposited'] - result['Unallocated'] - result['Allocated & Unused']
+    result['% Used'] = result['Used']/result['Deposited']*100
+    result['Institute'] = result['Institute'].astype(str)
+    return result.sort_values(keys).reset_index(drop=True)
+
+# Write out as csv or print the report
+def writereport(result, args):
+    # write out as csv, leave off the row indices
+    if args.csvfile is not None:
+        result.to_csv(args.csvfile, index=False)
+    elif args.jsonfile is not None:
+        result.to_json(args.jsonfile, orient='records', date_format='iso')
+    else:
+        # set display format of floats to 2dp and output all rows
+        pandas.options.display.float_format = '{:.2f}'.format
+        pandas.options.display.max_rows = None
+        print(result)
+
+
 # Put main in a function so it is importable.
 def main(argv):
 
@@ -39,57 +128,69 @@ def main(argv):
     # Update Gold allocations from pipe-separated stdin input
     # Id|Account|Projects|StartTime|EndTime|Amount|Deposited|Description
 
-    if args.input:
-        dataframe = pandas.read_csv(sys.stdin, sep='|')
-        # filter out the lines where StartTime is infinite
-        dataframe = dataframe[dataframe.StartTime != "-infinity"]
+    if args.input or args.fromstore:
+        if args.fromstore:
+            # imported here so pyarrow is only needed when using the store
+            import gold_store
+            if args.asof is not None:
+                asof = datetime.datetime.strptime(args.asof, "%Y-%m-%d").date()
+            else:
+                asof = datetime.date.today()
+            if args.forecast is not None:
+                since = None
+                if args.since is not None:
+                    since = datetime.datetime.strptime(args.since, "%Y-%m-%d").date()
+                dataframe = gold_store.loadrange(args.store, since, asof)
+            else:
+                dataframe = gold_store.loadasof(args.store, asof)
+            if dataframe is None:
+                print("No Gold snapshots stored on or before " + str(asof))
+                exit(0)
+        elif args.forecast is not None:
+            print("--forecast needs the history in the snapshot store, use --from-store.")
+            exit(1)
+        else:
+            dataframe = readallocations(sys.stdin, args.chunksize)
+        if dataframe.empty:
+            print("No allocations found in input.")
+            exit(0)
 
-        # filter by date
+        # filter by one or more period start dates
         if args.date is not None:
-            dataframe = dataframe[dataframe.StartTime == args.date]
-            # check we got any results for that date
+            dates = pandas.to_datetime(args.date)
+            dataframe = dataframe[dataframe.StartTime.isin(dates)]
+            found = set(dataframe.StartTime.unique())
+            for date, requested in zip(args.date, dates):
+                if requested not in found:
+                    print("No results found for start date " + date)
+            # check we got any results for those dates
             if dataframe.empty:
-                print("No results found for start date " + args.date)
                 exit(0)
 
-        # add an institute column. We only want the first item in the split
-        dataframe['Institute'] = dataframe['Projects'].str.split('_', 1).str[0]
+        dataframe = addinstitutes(dataframe)
 
         # filter by institute
         if args.institute is not None:
             # select all lines where institute matches
-            dataframe = dataframe[dataframe.Institute == args.institute]
-            # check we got any results for that institute
+            dataframe = dataframe[dataframe.Institute.isin(args.institute)]
+            # check we got any results for those institutes
             if dataframe.empty:
-                print("No results found for institute " + args.institute)
+                print("No results found for institute " + ", ".join(args.institute))
                 exit(0)
 
-        # filter out _allocation projects and everything else separately
-        allocs = dataframe[dataframe.Projects.str.contains("_allocation")]
-        projects = dataframe[~dataframe.Projects.str.contains("_allocation")]
-
-        # We want this output:
-        # StartTime  EndTime  Institute  Deposited  Unallocated  Allocated & Unused  Used  % Used
-        projects = projects.rename(columns={'Amount':'Allocated & Unused'})
-        allocs = allocs.rename(columns={'Amount':'Unallocated'})
-        # sum the unused time for each institute in this period
-        unused = projects.groupby(['StartTime','Institute'])['Allocated & Unused'].sum().reset_index()
-        # merge the columns we want from allocs and unused
-        # need a left outer join to keep allocs with no subprojects
-        result = allocs[['StartTime', 'EndTime', 'Institute', 'Deposited', 'Unallocated']].merge(unused, on=['StartTime', 'Institute'], how='left')
-        # replace NaN with 0
-        result['Allocated & Unused'] = result['Allocated & Unused'].fillna(0)
-        result['Used'] = result['Deposited'] - result['Unallocated'] - result['Allocated & Unused']
-        result['% Used'] = result['Used']/result['Deposited']*100
-
-        # write out as csv, leave off the row indices
-        if args.csvfile is not None:
-           result.to_csv(args.csvfile, index=False)
+        if args.forecast is not None:
+            import gold_forecast
+            if args.forecast == "consortium":
+                import gold_usage
+                history = gold_forecast.consortiumhistory(dataframe, gold_usage.readconsortia(args.consortia))
+            elif args.forecast == "institute":
+                history = gold_forecast.institutehistory(dataframe)
+            else:
+                history = gold_forecast.projecthistory(dataframe)
+            result = gold_forecast.forecast(history, args.window, args.under)
+            writereport(result.rename(columns={'Series':args.forecast.capitalize()}), args)
         else:
-            # set display format of floats to 2dp and output all rows
-            pandas.options.display.float_format = '{:.2f}'.format
-            pandas.options.display.max_rows = None
-            print(result)
+            writereport(usagereport(dataframe), args)
 
     else:
         print("No input was specified.")
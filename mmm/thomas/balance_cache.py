@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Shared cache of Gold balances for the budgets and gbalance wrappers.
+
+# Gets every account balance and every project's users from Gold in one
+# session and writes one small file per user holding the balances of the
+# projects they are in, so the wrappers can answer from a local file
+# instead of each user running their own ssh and Gold query:
+#   <cache>/<username>   - pipe-separated Id|Name|Amount|Reserved|Available
+#                          after an "# as of" line
+#   <cache>/.updated     - time of the last successful refresh
+# Gold account names are the project names.
+
+# Must be run as root: each file is owned by and only readable by its
+# user, so nobody can see the balances of projects they aren't in.
+
+import os
+import sys
+import argparse
+import datetime
+import gold_client
+
+DEFAULT_CACHE = "/shared/ucl/sysops/gold-balance-cache"
+
+BALANCE_FIELDS = ["Id", "Name", "Amount", "Reserved", "Available"]
+BALANCE_COMMAND = ["gbalance", "-h", "--raw", "--show", ",".join(BALANCE_FIELDS)]
+PROJECT_COMMAND = ["glsproject", "--raw", "--show", "Name,Users"]
+
+def getargs(argv):
+    parser = argparse.ArgumentParser(description="Refresh the shared cache of Gold balances used by budgets and gbalance.")
+    parser.add_argument("--refresh", help="Get all balances from Gold and rewrite the cache", action='store_true')
+    parser.add_argument("--cache", dest="cache", default=os.environ.get("GOLD_BALANCE_CACHE", DEFAULT_CACHE), help="Cache directory (default $GOLD_BALANCE_CACHE or " + DEFAULT_CACHE + ")")
+    parser.add_argument("--verbose", help="", action='store_true')
+
+    # Show the usage if no arguments are supplied
+    if len(argv) < 1:
+        parser.print_usage()
+        exit(1)
+
+    return parser.parse_args(argv)
+# end getargs
+
+
+# Map each user to the balances of every project they are in.
+# Users is a comma-separated list in Gold's --raw output.
+def balancesbyuser(balances, projects):
+    byname = {}
+    for balance in balances:
+        byname.setdefault(balance['Name'], []).append(balance)
+    byuser = {}
+    for project in projects:
+        for user in (project.get('Users') or "").split(","):
+            user = user.strip()
+            if user != "":
+                byuser.setdefault(user, []).extend(byname.get(project['Name'], []))
+    return byuser
+
+def formatbalances(balances, asof):
+    lines = ["# as of " + asof, "|".join(BALANCE_FIELDS)]
+    for balance in sorted(balances, key=lambda b: b['Name']):
+        lines.append("|".join(balance[field] for field in BALANCE_FIELDS))
+    return "\n".join(lines) + "\n"
+
+# Write atomically so the wrappers never read half a file. The file is
+# only readable by root until it is given to its owner, or made
+# world-readable if it has none.
+def writefile(path, text, owner=None):
+    if os.path.exists(path + ".tmp"):
+        os.remove(path + ".tmp")
+    with os.fdopen(os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+        f.write(text)
+    if owner is None:
+        os.chmod(path + ".tmp", 0o644)
+    else:
+        os.chown(path + ".tmp", owner, -1)
+    os.replace(path + ".tmp", path)
+
+# The uid to give a user's file, or None if they have no account here
+def fileowner(username):
+    import pwd
+    try:
+        return pwd.getpwnam(username).pw_uid
+    except KeyError:
+        return None
+
+def refresh(cache, verbose=False):
+    # without root the files can't be given to their users
+    if os.geteuid() != 0:
+        print("balance_cache.py --refresh must be run as root, so each user's balances are only readable by them.", file=sys.stderr)
+        exit(1)
+    try:
+        balanceresult, projectresult = gold_client.GoldClient().batch([BALANCE_COMMAND, PROJECT_COMMAND])
+    except gold_client.GoldError as err:
+        print(err, file=sys.stderr)
+        exit(1)
+    for result in (balanceresult, projectresult):
+        if result.returncode != 0:
+            print(" ".join(result.command) + " failed with exit status " + str(result.returncode), file=sys.stderr)
+            exit(1)
+
+    asof = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    byuser = balancesbyuser(balanceresult.records(), projectresult.records())
+    os.makedirs(cache, exist_ok=True)
+    for user, balances in byuser.items():
+        # usernames come from Gold: never write outside the cache
+        if os.path.basename(user) != user or user.startswith("."):
+            continue
+        owner = fileowner(user)
+        if owner is None:
+            # a Gold user with no account here
+            continue
+        writefile(os.path.join(cache, user), formatbalances(balances, asof), owner)
+    # users no longer in any project get no balances, not stale ones
+    for name in os.listdir(cache):
+        if not name.startswith(".") and not name.endswith(".tmp") and name not in byuser:
+            os.remove(os.path.join(cache, name))
+    writefile(os.path.join(cache, ".updated"), asof + "\n")
+    if verbose:
+        print("Cached balances for " + str(len(byuser)) + " users in " + cache)
+
+
+# Put main in a function so it is importable.
+def main(argv):
+
+    try:
+        args = getargs(argv)
+    except ValueError as err:
+        print(err)
+        exit(1)
+
+    if args.refresh:
+        refresh(args.cache, args.verbose)
+# end main
+
+# When not imported, use the normal global arguments
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Work out which cluster we are on, once.
+
+# The node name comes from /opt/sge/default/common/cluster_name if it exists,
+# then whereami, then the hostname if it names a cluster, and only then
+# getfqdn, which can block for a long time on DNS. gold/functions.sh
+# works it out in the same order. It is kept for the life of the process
+# and in a small cache file that can also be sourced by shell scripts:
+#   CLUSTER_NODENAME=thomas
+#   CLUSTER_NAME=thomas
+#   CLUSTER_DB=thomas
+#   CLUSTER_HAS_GOLD=1
+# Only CLUSTER_NODENAME is read back, the rest is worked out from it.
+# Home directories are shared between clusters, so each host has its own
+# cache file, cluster_identity.HOSTNAME. gold/functions.sh reads and
+# writes the same files.
+
+import os
+import sys
+import time
+import shlex
+import socket
+import argparse
+import subprocess
+
+CLUSTER_NAME_FILE = "/opt/sge/default/common/cluster_name"
+WHEREAMI = "/shared/ucl/apps/cluster-bin/whereami"
+CACHE_DIR = os.environ.get("CLUSTER_IDENTITY_CACHE_DIR", "~/.cache")
+DEFAULT_CACHE = os.path.join(CACHE_DIR, "cluster_identity." + socket.gethostname())
+# Seconds before the cache file is worked out again
+CACHE_TTL = 24 * 60 * 60
+
+# Clusters the MMM tools know about, and those with Gold
+MMM_CLUSTERS = ["thomas", "michael", "young"]
+GOLD_CLUSTERS = ["thomas", "michael", "young", "myriad", "kathleen"]
+
+# The node name for this process, once known
+_nodename = None
+
+def getargs(argv):
+    parser = argparse.ArgumentParser(description="Show which cluster this is, as shell variable assignments.")
+    parser.add_argument("--refresh", help="Work it out again instead of using the cache file", action='store_true')
+    parser.add_argument("--cache", dest="cache", default=DEFAULT_CACHE, help="Cache file (default " + DEFAULT_CACHE + ")")
+    return parser.parse_args(argv)
+# end getargs
+
+
+# The cluster in a node name, from the clusters given
+def matchcluster(nodename, clusters=MMM_CLUSTERS):
+    for cluster in clusters:
+        if cluster in nodename:
+            return cluster
+    return None
+
+# Work out the node name without any cache
+def resolvenodename():
+    # if the cluster_name file exists, use that
+    try:
+        with open(CLUSTER_NAME_FILE, 'r') as f:
+            return f.read().rstrip()
+    except IOError:
+        pass
+    try:
+        whereami = subprocess.run([WHEREAMI], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        if whereami.returncode == 0 and whereami.stdout.strip() != "":
+            return whereami.stdout.strip()
+    except OSError:
+        pass
+    # the hostname needs no DNS lookup and is usually enough
+    hostname = socket.gethostname().casefold()
+    if matchcluster(hostname, GOLD_CLUSTERS) is not None:
+        return hostname
+    # fall back to getfqdn
+    return socket.getfqdn().casefold()
+
+# The node name from the cache file, or None if it is missing or too old
+def readcache(path):
+    path = os.path.expanduser(path)
+    try:
+        if time.time() - os.path.getmtime(path) > CACHE_TTL:
+            return None
+        with open(path, 'r') as f:
+            for line in f:
+                key, _, value = line.rstrip("\n").partition("=")
+                if key == "CLUSTER_NODENAME":
+                    values = shlex.split(value)
+                    return values[0] if len(values) > 0 else None
+    except (OSError, ValueError):
+        pass
+    return None
+
+def shellvariables(nodename):
+    cluster = matchcluster(nodename)
+    return "".join(key + "=" + shlex.quote(value) + "\n" for key, value in [
+        ("CLUSTER_NODENAME", nodename),
+        ("CLUSTER_NAME", cluster or ""),
+        ("CLUSTER_DB", databasefor(nodename)),
+        ("CLUSTER_HAS_GOLD", "1" if matchcluster(nodename, GOLD_CLUSTERS) is not None else "0")])
+
+# Writing the cache is only an optimisation, so failing to is not an error
+def writecache(path, nodename):
+    path = os.path.expanduser(path)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", 'w') as f:
+            f.write(shellvariables(nodename))
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+def nodename(cache=DEFAULT_CACHE, refresh=False):
+    global _nodename
+    if _nodename is None or refresh:
+        found = None if refresh else readcache(cache)
+        if found is None:
+            found = resolvenodename()
+            writecache(cache, found)
+        _nodename = found
+    return _nodename
+
+# The MMM database for a node name
+def databasefor(nodename):
+    if "young" in nodename:
+        return "young"
+    return "thomas"
+
+# The MMM cluster we are on, or None if it isn't one
+def cluster():
+    return matchcluster(nodename())
+
+def database():
+    return databasefor(nodename())
+
+def hasgold():
+    return matchcluster(nodename(), GOLD_CLUSTERS) is not None
+
+
+# Put main in a function so it is importable.
+def main(argv):
+
+    args = getargs(argv)
+    print(shellvariables(nodename(args.cache, args.refresh)), end="")
+# end main
+
+# When not imported, use the normal global arguments
+if __name__ == "__main__":
+    main(sys.argv[1:])
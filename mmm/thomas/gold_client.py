@@ -0,0 +1,144 @@
+# Client for running Gold commands on the Gold server over ssh.
+
+# All commands go over one multiplexed ssh connection (ControlMaster), so
+# only the first command pays for the ssh handshake and the master stays
+# up for a minute afterwards for the next one. The master is started on
+# its own with its output thrown away, so it never holds open the stderr
+# of whatever is capturing ours. A batch of commands is sent
+# as one remote script, with a marker line after each command's output so
+# the outputs and exit statuses can be split apart again.
+
+# The transport is anything with a run(command) method returning a
+# subprocess.CompletedProcess, so a different ssh (or a local fake of one)
+# can be used instead.
+
+import os.path
+import io
+import csv
+import uuid
+import shlex
+import subprocess
+
+GOLD_HOST = "util-ha-nfs"
+
+# ssh expands the %r, %h and %p itself
+DEFAULT_CONTROL_PATH = "~/.ssh/gold-%r@%h:%p"
+
+class GoldError(Exception):
+    pass
+
+# Runs commands on the Gold host through one shared ssh connection
+class SSHTransport:
+
+    def __init__(self, host=GOLD_HOST, ssh="ssh", control_path=DEFAULT_CONTROL_PATH, persist="60"):
+        self.host = host
+        self.ssh = ssh
+        self.control_path = os.path.expanduser(control_path)
+        self.persist = persist
+
+    # Start the master connection if there isn't one. Returns False if there
+    # is nowhere to put its socket, and commands then connect by themselves.
+    def startmaster(self):
+        try:
+            os.makedirs(os.path.dirname(self.control_path), mode=0o700, exist_ok=True)
+        except OSError:
+            return False
+        check = subprocess.run([self.ssh, "-o", "ControlPath=" + self.control_path, "-O", "check", self.host],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if check.returncode != 0:
+            # if this fails, commands just connect by themselves
+            subprocess.run([self.ssh,
+                            "-o", "ControlMaster=yes",
+                            "-o", "ControlPath=" + self.control_path,
+                            "-o", "ControlPersist=" + self.persist,
+                            "-o", "BatchMode=yes",
+                            "-o", "LogLevel=QUIET",
+                            "-MNf", self.host],
+                           stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return True
+
+    def sshargs(self):
+        if not self.startmaster():
+            return [self.ssh, "-o", "BatchMode=yes", self.host]
+        return [self.ssh,
+                "-o", "ControlMaster=no",
+                "-o", "ControlPath=" + self.control_path,
+                "-o", "BatchMode=yes",
+                self.host]
+
+    # Run a command string in the remote shell, passing its stderr through
+    def run(self, command):
+        return subprocess.run(self.sshargs() + [command], stdout=subprocess.PIPE, universal_newlines=True)
+
+    # Shut down the master connection instead of waiting for it to time out
+    def close(self):
+        subprocess.run([self.ssh, "-o", "ControlPath=" + self.control_path, "-O", "exit", self.host],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# The output of one command in a batch
+class GoldResult:
+
+    def __init__(self, command, returncode, output):
+        self.command = command
+        self.returncode = returncode
+        self.output = output
+
+    # Records from --raw output, as a list of dictionaries keyed by the header
+    def records(self):
+        return parseraw(self.output)
+
+
+# Gold --raw output is pipe-separated with a header line
+def parseraw(output):
+    return list(csv.DictReader(io.StringIO(output), delimiter='|'))
+
+# A command is a list of the command name and its arguments
+def quotecommand(command):
+    return " ".join(shlex.quote(str(arg)) for arg in command)
+
+
+class GoldClient:
+
+    def __init__(self, transport=None):
+        if transport is None:
+            transport = SSHTransport()
+        self.transport = transport
+
+    # Run one Gold command and return its output, raising GoldError if it failed
+    def run(self, *command):
+        result = self.batch([list(command)])[0]
+        if result.returncode != 0:
+            raise GoldError(quotecommand(command) + " failed with exit status " + str(result.returncode))
+        return result.output
+
+    # Run one Gold command with --raw and return its output as records
+    def query(self, *command):
+        return parseraw(self.run(*command, "--raw"))
+
+    # Run several commands in one remote session, returning a GoldResult for each.
+    # Each command runs in its own subshell so a failing one doesn't stop the rest.
+    # A newline is always printed before the marker in case the output didn't end
+    # with one, and taken off again when splitting.
+    def batch(self, commands):
+        marker = "==gold-client-" + uuid.uuid4().hex + "=="
+        script = "".join("(" + quotecommand(command) + "); printf '\\n%s %d %d\\n' " + marker + " " + str(i) + " $?; "
+                         for i, command in enumerate(commands))
+        completed = self.transport.run(script)
+
+        results = []
+        section = []
+        for line in completed.stdout.splitlines(True):
+            if line.startswith(marker + " "):
+                index, returncode = line.split()[1:3]
+                output = "".join(section)
+                results.append(GoldResult(commands[int(index)], int(returncode), output[:-1] if output.endswith("\n") else output))
+                section = []
+            else:
+                section.append(line)
+
+        # the session itself failed part way through
+        if len(results) != len(commands):
+            raise GoldError("Gold session ended after " + str(len(results)) + " of " + str(len(commands))
+                            + " commands, ssh exit status " + str(completed.returncode))
+        return results
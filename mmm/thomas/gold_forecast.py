@@ -0,0 +1,98 @@
+# Burn-rate and exhaustion forecasting for Gold allocations.
+
+# Works on a history of allocation snapshots from the Gold snapshot store.
+# Every project, institute or consortium in every allocation period is one
+# usage series, and the usage rate of all the series is fitted at once with
+# NumPy reductions over the series codes rather than one fit per series.
+
+# The rate is a least-squares fit to the snapshots in the trailing window.
+# Series with only one snapshot in the window are fitted through zero
+# usage at the start of the period instead.
+
+import numpy
+import pandas
+import allocations
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Institute usage at every snapshot: the same report as allocations.py
+# gives for one moment, once per snapshot
+def institutehistory(history):
+    report = allocations.usagereport(history, by=['SnapshotTime'])
+    return report.rename(columns={'Institute':'Series'})[['Series', 'StartTime', 'EndTime', 'SnapshotTime', 'Deposited', 'Used']]
+
+# Consortium usage at every snapshot, summed from its institutes' usage.
+# consortia maps Institute to Consortium, as gold_usage.readconsortia gives,
+# and any institute not in it is its own consortium.
+def consortiumhistory(history, consortia):
+    institutes = institutehistory(history)
+    institutes['Series'] = institutes['Series'].map(lambda inst: consortia.get(inst, inst))
+    return institutes.groupby(['Series', 'StartTime', 'EndTime', 'SnapshotTime'], as_index=False)[['Deposited', 'Used']].sum()
+
+# Project usage at every snapshot, from each project's own allocation
+def projecthistory(history):
+    projects = history[~history.IsAllocation]
+    return pandas.DataFrame({'Series': projects.Projects.astype(str),
+                             'StartTime': projects.StartTime,
+                             'EndTime': projects.EndTime,
+                             'SnapshotTime': projects.SnapshotTime,
+                             'Deposited': projects.Deposited,
+                             'Used': projects.Deposited - projects.Amount})
+
+# Fit a usage rate for every series and project when each will run out.
+# window is in days, under is the fraction of Deposited below which a
+# series is expected to underspend.
+def forecast(history, window=14, under=0.8):
+    # periods that had not started yet when a snapshot was taken say nothing about their usage
+    history = history[history.SnapshotTime >= history.StartTime]
+    if history.empty:
+        return history.head(0)
+    history = history.sort_values(['Series', 'StartTime', 'SnapshotTime']).reset_index(drop=True)
+    # one integer code per series, sorted so each series is contiguous
+    codes = history.groupby(['Series', 'StartTime'], sort=False).ngroup().to_numpy()
+    nseries = codes.max() + 1
+
+    # days into the allocation period for each snapshot, and usage then
+    t = (history.SnapshotTime - history.StartTime).dt.total_seconds().to_numpy() / SECONDS_PER_DAY
+    y = history.Used.to_numpy(dtype=float)
+
+    # the last row of each series is its latest snapshot
+    last = numpy.r_[numpy.nonzero(numpy.diff(codes))[0], len(codes) - 1]
+    t_last = t[last]
+
+    # least squares over the trailing window, as sums per series
+    w = (t >= t_last[codes] - window).astype(float)
+    n = numpy.bincount(codes, weights=w, minlength=nseries)
+    sx = numpy.bincount(codes, weights=w * t, minlength=nseries)
+    sy = numpy.bincount(codes, weights=w * y, minlength=nseries)
+    sxx = numpy.bincount(codes, weights=w * t * t, minlength=nseries)
+    sxy = numpy.bincount(codes, weights=w * t * y, minlength=nseries)
+    denom = n * sxx - sx * sx
+    # through the origin at the start of the period, using every snapshot
+    oxx = numpy.bincount(codes, weights=t * t, minlength=nseries)
+    oxy = numpy.bincount(codes, weights=t * y, minlength=nseries)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        fitted = (n * sxy - sx * sy) / denom
+        origin = numpy.where(oxx > 0, oxy / oxx, 0.0)
+        rate = numpy.where((n >= 2) & (denom > 1e-9), fitted, origin)
+    # refunds can make usage go down: that is not a negative burn rate
+    rate = numpy.clip(rate, 0.0, None)
+
+    result = history.loc[last, ['Series', 'StartTime', 'EndTime', 'SnapshotTime', 'Deposited', 'Used']].reset_index(drop=True)
+    result['Rate per day'] = rate
+    remaining = (result.Deposited - result.Used).to_numpy(dtype=float)
+    days_left = (result.EndTime - result.SnapshotTime).dt.total_seconds().to_numpy() / SECONDS_PER_DAY
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        to_exhaustion = numpy.where((rate > 0) & (remaining > 0), remaining / rate, numpy.nan)
+        projected = numpy.where(result.Deposited > 0, (result.Used + rate * days_left) / result.Deposited, numpy.nan)
+    result['Exhaustion'] = result.SnapshotTime + pandas.to_timedelta(to_exhaustion, unit='D')
+    result['Projected % Used'] = 100 * projected
+
+    result['Forecast'] = "on track"
+    result.loc[projected < under, 'Forecast'] = "underspend"
+    result.loc[result.Exhaustion < result.EndTime, 'Forecast'] = "overspend"
+    # already run out or no end to the period: nothing to forecast
+    result.loc[remaining <= 0, 'Forecast'] = "exhausted"
+    result.loc[result.EndTime.isna(), 'Forecast'] = "no end date"
+    return result
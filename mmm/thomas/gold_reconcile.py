@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# Reconcile completed SAFE "Move gold" tickets against what happened in Gold.
+
+# Loads the completed Move gold tickets from our DB and the Gold transaction
+# and allocation dumps into DataFrames, joins them and writes out every
+# problem found as CSV:
+#   missing transfer   - ticket with no matching Gold transfer
+#   amount mismatch    - transfer between the same budgets with a different amount
+#   double applied     - more matching transfers than tickets
+#   no ticket          - SAFE transfer in Gold with no completed ticket
+#   allocation mismatch - ticket source allocation missing or not in the source account
+#   not uploaded       - source allocation differs from what safegold last sent SAFE
+
+# Transactions are from:
+#   glstxn --raw -O Account -A Transfer --show Id,Key,Child,Amount,Description,CreationTime
+# where Key is the source account and Child the destination account.
+# Allocations are from glsalloc --raw.
+# Without dump files, both are fetched from Gold in one ssh session.
+
+import os.path
+import sys
+import io
+import json
+import argparse
+from contextlib import closing
+import mysql.connector
+from mysql.connector import errorcode
+import pandas
+import thomas_queries
+import gold_client
+
+# transfergold is given this description by safe_tickets.movegold
+SAFE_DESCRIPTION = "transfer_received_from_SAFE"
+
+# Gold amounts are in hours to 2dp, SAFE's may not be
+AMOUNT_DECIMALS = 2
+
+# The Gold commands the dumps come from
+TRANSFERS_COMMAND = ["glstxn", "-h", "--raw", "-O", "Account", "-A", "Transfer", "--show", "Id,Key,Child,Amount,Description,CreationTime"]
+ALLOCATIONS_COMMAND = ["glsalloc", "-h", "--raw", "--show", "Id,Account,Projects,StartTime,EndTime,Amount,Deposited,Description"]
+
+def getargs(argv):
+    parser = argparse.ArgumentParser(description="Reconcile completed SAFE Move gold tickets against Gold transactions and allocations.")
+    parser.add_argument("--transactions", dest="txnfile", default=None, help="Gold transfer transactions, from glstxn --raw (default is to get them from Gold)")
+    parser.add_argument("--allocations", dest="allocfile", default=None, help="Gold allocations, from glsalloc --raw (default is to get them from Gold)")
+    parser.add_argument("--snapshot", dest="snapshot", default=None, help="Also check against this safegold upload snapshot")
+    parser.add_argument("--csv", dest="csvfile", help="Write out CSV to this file instead of stdout")
+    parser.add_argument("--debug", help="", action='store_true')
+
+    return parser.parse_args(argv)
+# end getargs
+
+
+# Get completed Move gold tickets from our DB as a DataFrame
+def readtickets():
+    try:
+        with closing(mysql.connector.connect(option_files=os.path.expanduser('~/.thomas.cnf'), database='thomas')) as conn, closing(conn.cursor(dictionary=True)) as cursor:
+            cursor.execute(thomas_queries.completedgoldtickets())
+            tickets = pandas.DataFrame(cursor.fetchall(), columns=['id', 'project', 'source_account_id', 'source_allocation', 'gold_amount'])
+    except mysql.connector.Error as err:
+        if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
+            print("Access denied: Something is wrong with your user name or password")
+        elif err.errno == errorcode.ER_BAD_DB_ERROR:
+            print("Database does not exist")
+        else:
+            print(err)
+        exit(1)
+    tickets = tickets.rename(columns={'id':'ticket_id'})
+    tickets['source_account_id'] = pandas.to_numeric(tickets['source_account_id'], errors='coerce').astype('Int64')
+    tickets['source_allocation'] = pandas.to_numeric(tickets['source_allocation'], errors='coerce').astype('Int64')
+    tickets['amount'] = pandas.to_numeric(tickets['gold_amount'], errors='coerce').round(AMOUNT_DECIMALS)
+    return tickets
+
+# Read the SAFE transfers out of a glstxn --raw dump and name the
+# destination project using the account each allocation belongs to
+def readtransfers(filename, allocations):
+    txns = pandas.read_csv(filename, sep='|', dtype={'Description': str})
+    txns = txns[txns['Description'].fillna("").str.contains(SAFE_DESCRIPTION, regex=False)]
+    txns = txns.rename(columns={'Id':'txn_id', 'Key':'source_account_id', 'Child':'dest_account_id'})
+    txns['source_account_id'] = pandas.to_numeric(txns['source_account_id'], errors='coerce').astype('Int64')
+    txns['dest_account_id'] = pandas.to_numeric(txns['dest_account_id'], errors='coerce').astype('Int64')
+    txns['amount'] = txns['Amount'].astype(float).abs().round(AMOUNT_DECIMALS)
+    accounts = allocations[['Account', 'Projects']].drop_duplicates('Account')
+    accounts = accounts.rename(columns={'Account':'dest_account_id', 'Projects':'project'})
+    return txns.merge(accounts, on='dest_account_id', how='left')
+
+def readallocations(filename):
+    allocations = pandas.read_csv(filename, sep='|', dtype={'Projects': str, 'Description': str})
+    allocations['Account'] = allocations['Account'].astype('Int64')
+    return allocations
+
+# Compare tickets and transfers by source account, destination project and
+# amount. Each key is counted on both sides so that repeated identical
+# transfers are only a problem when there are more of them than tickets.
+def matchtransfers(tickets, txns):
+    key = ['source_account_id', 'project', 'amount']
+    ticketcounts = tickets.groupby(key, dropna=False).agg(
+        ticket_count=('ticket_id', 'size'),
+        ticket_ids=('ticket_id', lambda ids: " ".join(str(i) for i in sorted(ids))))
+    txncounts = txns.groupby(key, dropna=False).agg(
+        transfer_count=('txn_id', 'size'),
+        txn_ids=('txn_id', lambda ids: " ".join(str(i) for i in sorted(ids))))
+    counts = ticketcounts.join(txncounts, how='outer').reset_index()
+    counts[['ticket_count', 'transfer_count']] = counts[['ticket_count', 'transfer_count']].fillna(0).astype(int)
+
+    counts['problem'] = None
+    counts.loc[counts.transfer_count < counts.ticket_count, 'problem'] = "missing transfer"
+    counts.loc[(counts.transfer_count > counts.ticket_count) & (counts.ticket_count > 0), 'problem'] = "double applied"
+    counts.loc[counts.ticket_count == 0, 'problem'] = "no ticket"
+    counts = counts[counts.problem.notna()]
+
+    # A missing transfer and an unticketed transfer between the same two
+    # budgets is really a transfer of the wrong amount: label both sides
+    pair = ['source_account_id', 'project']
+    missing = counts.loc[counts.transfer_count == 0, pair]
+    unticketed = counts.loc[counts.ticket_count == 0, pair]
+    mismatched = missing.merge(unticketed, on=pair).drop_duplicates().assign(mismatched=True)
+    counts = counts.merge(mismatched, on=pair, how='left')
+    counts.loc[counts.mismatched.notna() & ((counts.transfer_count == 0) | (counts.ticket_count == 0)), 'problem'] = "amount mismatch"
+    return counts.drop(columns=['mismatched'])
+
+# Get whichever of the transfer and allocation dumps we weren't given
+# from Gold, in one session. Returns file-like objects for read_csv.
+def fetchdumps(args):
+    sources = {'txnfile': args.txnfile, 'allocfile': args.allocfile}
+    needed = [(name, command) for name, command in [('txnfile', TRANSFERS_COMMAND), ('allocfile', ALLOCATIONS_COMMAND)]
+              if sources[name] is None]
+    if len(needed) > 0:
+        try:
+            results = gold_client.GoldClient().batch([command for _, command in needed])
+        except gold_client.GoldError as err:
+            print(err)
+            exit(1)
+        for (name, command), result in zip(needed, results):
+            if result.returncode != 0:
+                print(" ".join(command) + " failed with exit status " + str(result.returncode))
+                exit(1)
+            sources[name] = io.StringIO(result.output)
+    return sources['txnfile'], sources['allocfile']
+
+# Check each ticket's source allocation exists and belongs to its source account
+def matchallocations(tickets, allocations):
+    allocs = allocations[['Id', 'Account']].rename(columns={'Id':'source_allocation', 'Account':'allocation_account'})
+    allocs['source_allocation'] = allocs['source_allocation'].astype('Int64')
+    checked = tickets.merge(allocs, on='source_allocation', how='left')
+    wrong = checked[checked.source_allocation.notna() & (checked.allocation_account != checked.source_account_id).fillna(True)]
+    wrong = wrong.assign(problem="allocation mismatch", ticket_count=1, ticket_ids=wrong.ticket_id.astype(str))
+    return wrong[['problem', 'ticket_ids', 'ticket_count', 'source_account_id', 'source_allocation', 'project', 'amount', 'allocation_account']]
+
+# Check the source allocations are as safegold last uploaded them to SAFE
+def matchsnapshot(tickets, allocations, snapshotfile):
+    with open(os.path.expanduser(snapshotfile), 'r') as f:
+        snapshot = json.load(f)
+    uploaded = pandas.DataFrame([(int(i), float(v[0]), float(v[1])) for i, v in snapshot.items()],
+                                columns=['source_allocation', 'uploaded_amount', 'uploaded_deposited'])
+    uploaded['source_allocation'] = uploaded['source_allocation'].astype('Int64')
+    current = allocations[['Id', 'Amount', 'Deposited']].rename(columns={'Id':'source_allocation'})
+    current['source_allocation'] = current['source_allocation'].astype('Int64')
+    used = tickets[['source_allocation']].dropna().drop_duplicates()
+    checked = used.merge(current, on='source_allocation').merge(uploaded, on='source_allocation', how='left')
+    stale = checked[(checked.Amount.round(AMOUNT_DECIMALS) != checked.uploaded_amount.round(AMOUNT_DECIMALS))
+                    | (checked.Deposited.round(AMOUNT_DECIMALS) != checked.uploaded_deposited.round(AMOUNT_DECIMALS))]
+    return stale.assign(problem="not uploaded")
+
+
+# Put main in a function so it is importable.
+def main(argv):
+
+    try:
+        args = getargs(argv)
+    except ValueError as err:
+        print(err)
+        exit(1)
+
+    txnfile, allocfile = fetchdumps(args)
+    allocations = readallocations(allocfile)
+    tickets = readtickets()
+    txns = readtransfers(txnfile, allocations)
+    if args.debug:
+        print("Tickets: " + str(len(tickets)) + ", SAFE transfers: " + str(len(txns)) + ", allocations: " + str(len(allocations)), file=sys.stderr)
+
+    problems = [matchtransfers(tickets, txns), matchallocations(tickets, allocations)]
+    if args.snapshot is not None:
+        problems.append(matchsnapshot(tickets, allocations, args.snapshot))
+    result = pandas.concat(problems, ignore_index=True, sort=False)
+    result = result[['problem'] + [c for c in result.columns if c != 'problem']]
+
+    # write out as csv, leave off the row indices
+    if args.csvfile is not None:
+        result.to_csv(args.csvfile, index=False)
+    else:
+        result.to_csv(sys.stdout, index=False)
+    if args.debug:
+        print(str(len(result)) + " problems found.", file=sys.stderr)
+# end main
+
+# When not imported, use the normal global arguments
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Local store of Gold allocation snapshots.
+
+# Each ingest of glsalloc --raw is written as a new Parquet file in a
+# partition directory for its date and is never changed afterwards:
+#   <store>/date=2024-01-31/allocations-103000.parquet
+# Dumps of only the active allocations (glsalloc --raw -A) are stored as
+# active-103000.parquet beside them, and reports read only the full ones,
+# since an active-only snapshot is missing every inactive allocation.
+# Historical questions are then answered from the store instead of
+# dumping the whole allocation table from Gold again.
+
+# Needs pandas with pyarrow (or fastparquet) for Parquet support.
+
+import os
+import sys
+import glob
+import argparse
+import datetime
+import pandas
+import allocations
+
+DEFAULT_STORE = "~/gold_store"
+
+# Snapshot file names hold what they are a dump of and the time of day they were taken
+SCOPE_PREFIXES = {'full': "allocations-", 'active': "active-"}
+
+def getargs(argv):
+    parser = argparse.ArgumentParser(description="Store Gold allocation snapshots locally.")
+    parser.add_argument("--ingest", help="Store a snapshot of Gold allocations from stdin, input formed from glsalloc --raw", action='store_true')
+    parser.add_argument("--scope", dest="scope", choices=sorted(SCOPE_PREFIXES), default="full", help="Whether the input is every allocation (glsalloc --raw) or only active ones (glsalloc --raw -A), default full")
+    parser.add_argument("--list", help="List the snapshots in the store of this --scope", action='store_true')
+    parser.add_argument("--store", dest="store", default=DEFAULT_STORE, help="Location of the snapshot store (default " + DEFAULT_STORE + ")")
+    parser.add_argument("--chunksize", dest="chunksize", type=int, default=100000, help="Number of lines of input to read at a time")
+    parser.add_argument("--verbose", help="", action='store_true')
+
+    # Show the usage if no arguments are supplied
+    if len(argv) < 1:
+        parser.print_usage()
+        exit(1)
+
+    return parser.parse_args(argv)
+# end getargs
+
+
+# Parquet support is optional in pandas, so check for it before using it
+def checkparquet():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        try:
+            import fastparquet  # noqa: F401
+        except ImportError:
+            print("The Gold snapshot store needs pyarrow or fastparquet installed.", file=sys.stderr)
+            exit(1)
+
+# Get the time a snapshot was taken from its path
+def snapshottime(path):
+    date = os.path.basename(os.path.dirname(path))[len("date="):]
+    timeofday = os.path.basename(path).rsplit("-", 1)[1][:-len(".parquet")]
+    return datetime.datetime.strptime(date + timeofday, "%Y-%m-%d%H%M%S")
+
+# All snapshots of this scope in the store as (time, path), oldest first
+def listsnapshots(store, scope="full"):
+    pattern = "date=*/" + SCOPE_PREFIXES[scope] + "*.parquet"
+    paths = glob.glob(os.path.join(os.path.expanduser(store), pattern))
+    return sorted((snapshottime(p), p) for p in paths)
+
+# Write a dataframe of allocations into the store as a new snapshot.
+# Written under a temporary name first so readers never see a partial file.
+def ingest(store, dataframe, when=None, scope="full"):
+    checkparquet()
+    if when is None:
+        when = datetime.datetime.now()
+    partition = os.path.join(os.path.expanduser(store), "date=" + when.strftime("%Y-%m-%d"))
+    os.makedirs(partition, exist_ok=True)
+    path = os.path.join(partition, SCOPE_PREFIXES[scope] + when.strftime("%H%M%S") + ".parquet")
+    if os.path.exists(path):
+        print("Snapshot " + path + " already exists, not overwriting it.", file=sys.stderr)
+        exit(1)
+    dataframe.to_parquet(path + ".tmp", index=False)
+    os.rename(path + ".tmp", path)
+    return path
+
+# Read one snapshot, adding the time it was taken as SnapshotTime
+def readsnapshot(when, path, columns=None):
+    dataframe = pandas.read_parquet(path, columns=columns)
+    # not every Parquet engine keeps categories
+    if 'Projects' in dataframe.columns:
+        dataframe['Projects'] = dataframe['Projects'].astype('category')
+    dataframe['SnapshotTime'] = when
+    return dataframe
+
+# Get the allocations as they were in the latest full snapshot taken on or before this date.
+# Returns None if the store has no snapshot that old.
+def loadasof(store, asof, columns=None):
+    checkparquet()
+    # anything taken during the as-of date counts
+    cutoff = datetime.datetime.combine(asof, datetime.time.max)
+    earlier = [(when, path) for when, path in listsnapshots(store) if when <= cutoff]
+    if len(earlier) == 0:
+        return None
+    when, path = earlier[-1]
+    return readsnapshot(when, path, columns)
+
+# Get every full snapshot taken between these dates (inclusive) as one dataframe
+def loadrange(store, start=None, end=None, columns=None):
+    checkparquet()
+    snapshots = listsnapshots(store)
+    if start is not None:
+        snapshots = [(w, p) for w, p in snapshots if w.date() >= start]
+    if end is not None:
+        snapshots = [(w, p) for w, p in snapshots if w.date() <= end]
+    if len(snapshots) == 0:
+        return None
+    return pandas.concat([readsnapshot(w, p, columns) for w, p in snapshots], ignore_index=True)
+
+
+# Put main in a function so it is importable.
+def main(argv):
+
+    try:
+        args = getargs(argv)
+    except ValueError as err:
+        print(err)
+        exit(1)
+
+    # Store Gold allocations from pipe-separated stdin input
+    # Id|Account|Projects|StartTime|EndTime|Amount|Deposited|Description
+    if args.ingest:
+        dataframe = allocations.readallocations(sys.stdin, args.chunksize)
+        if dataframe.empty:
+            print("No allocations found in input, nothing stored.", file=sys.stderr)
+            exit(1)
+        path = ingest(args.store, dataframe, scope=args.scope)
+        if args.verbose:
+            print("Stored " + str(len(dataframe)) + " allocations in " + path)
+
+    if args.list:
+        for when, path in listsnapshots(args.store, args.scope):
+            print(when.strftime("%Y-%m-%d %H:%M:%S") + "  " + path)
+# end main
+
+# When not imported, use the normal global arguments
+if __name__ == "__main__":
+    main(sys.argv[1:])
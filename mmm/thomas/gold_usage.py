@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# Usage rollups from a Gold transaction dump.
+
+# Reads the charges for a period from one dump, formed from
+#   glstxn --raw -O Job -A Charge --show Id,Project,User,Amount,CreationTime -s START -e END
+# and sums them per user and project in chunks. The institute and
+# consortium rollups are then worked out from that much smaller table, and
+# every level is written as a Parquet table indexed by its key:
+#   <rollups>/<period>/user.parquet        indexed by User, Project
+#   <rollups>/<period>/project.parquet     indexed by Project
+#   <rollups>/<period>/institute.parquet   indexed by Institute
+#   <rollups>/<period>/consortium.parquet  indexed by Consortium
+# so per-consortium or per-project usage is a read of one small table
+# rather than a Gold query per project.
+
+# The institute is the part of the project name before the first _.
+# Consortia come from a CSV file with Institute,Consortium columns and
+# any institute not in it is its own consortium.
+
+# Needs pandas with pyarrow (or fastparquet) for Parquet support.
+
+import os
+import sys
+import argparse
+import pandas
+import gold_store
+
+DEFAULT_ROLLUPS = "~/gold_usage"
+
+LEVELS = ["user", "project", "institute", "consortium"]
+
+# The index of each level's table
+LEVEL_KEYS = {'user': ['User', 'Project'],
+              'project': ['Project'],
+              'institute': ['Institute'],
+              'consortium': ['Consortium']}
+
+# The glstxn --raw columns we need and the types to read them as
+DTYPES = {'Project': 'object',
+          'User': 'object',
+          'Amount': 'float64'}
+
+def getargs(argv):
+    parser = argparse.ArgumentParser(description="Roll up Gold usage by user, project, institute and consortium.")
+    parser.add_argument("--ingest", help="Roll up the charges in a Gold transaction dump from stdin, input formed from glstxn --raw", action='store_true')
+    parser.add_argument("--period", dest="period", help="Name of the period the rollups are for, eg. 2024-Q1", required=True)
+    parser.add_argument("--consortia", dest="consortia", help="CSV file mapping Institute to Consortium")
+    parser.add_argument("--show", dest="show", choices=LEVELS, help="Show the usage rolled up at this level")
+    parser.add_argument("-k", "--key", dest="key", action='append', help="With --show, only show these keys, eg. project or institute names (can be repeated)")
+    parser.add_argument("--rollups", dest="rollups", default=DEFAULT_ROLLUPS, help="Location of the rollup tables (default " + DEFAULT_ROLLUPS + ")")
+    parser.add_argument("--chunksize", dest="chunksize", type=int, default=100000, help="Number of lines of input to read at a time")
+    parser.add_argument("--csv", dest="csvfile", help="Write out CSV to this file in this location")
+    parser.add_argument("--verbose", help="", action='store_true')
+
+    # Show the usage if no arguments are supplied
+    if len(argv) < 1:
+        parser.print_usage()
+        exit(1)
+
+    return parser.parse_args(argv)
+# end getargs
+
+
+# Sum the charges per user and project, one chunk at a time. Each chunk
+# is reduced to its partial sums straight away, so only those are kept.
+def readcharges(stream, chunksize=100000):
+    partials = []
+    for chunk in pandas.read_csv(stream, sep='|', usecols=list(DTYPES.keys()), dtype=DTYPES, chunksize=chunksize):
+        chunk['User'] = chunk['User'].fillna("")
+        chunk['Amount'] = chunk['Amount'].abs()
+        partials.append(chunk.groupby(['User', 'Project'], sort=False)['Amount'].agg(['sum', 'size']))
+    if len(partials) == 0:
+        return pandas.DataFrame(columns=['User', 'Project', 'Charged', 'Transactions'])
+    usage = pandas.concat(partials).groupby(level=['User', 'Project']).sum().reset_index()
+    return usage.rename(columns={'sum':'Charged', 'size':'Transactions'})
+
+# Institute,Consortium CSV as a dictionary
+def readconsortia(filename):
+    if filename is None:
+        return {}
+    mapping = pandas.read_csv(filename, dtype=str)
+    return dict(zip(mapping['Institute'], mapping['Consortium']))
+
+# Add Institute and Consortium, worked out once per project
+def addhierarchy(usage, consortia):
+    projects = pandas.Series(usage['Project'].unique())
+    institutes = projects.str.split('_', n=1).str[0]
+    institutemap = dict(zip(projects, institutes))
+    usage['Institute'] = usage['Project'].map(institutemap)
+    usage['Consortium'] = usage['Institute'].map(lambda inst: consortia.get(inst, inst))
+    return usage
+
+# Every level's table from the user and project sums
+def rollup(usage):
+    tables = {}
+    tables['user'] = usage[['Consortium', 'Institute', 'Project', 'User', 'Charged', 'Transactions']]
+    tables['project'] = usage.groupby(['Consortium', 'Institute', 'Project']).agg(
+        Charged=('Charged', 'sum'), Transactions=('Transactions', 'sum'), Users=('User', 'nunique')).reset_index()
+    tables['institute'] = usage.groupby(['Consortium', 'Institute']).agg(
+        Charged=('Charged', 'sum'), Transactions=('Transactions', 'sum'),
+        Projects=('Project', 'nunique'), Users=('User', 'nunique')).reset_index()
+    tables['consortium'] = usage.groupby(['Consortium']).agg(
+        Charged=('Charged', 'sum'), Transactions=('Transactions', 'sum'), Institutes=('Institute', 'nunique'),
+        Projects=('Project', 'nunique'), Users=('User', 'nunique')).reset_index()
+    # sorted by their index so slices of it are contiguous
+    return {level: table.set_index(LEVEL_KEYS[level]).sort_index() for level, table in tables.items()}
+
+# Write each table under a temporary name first so readers never see a partial file
+def writerollups(rollups, period, tables):
+    gold_store.checkparquet()
+    directory = os.path.join(os.path.expanduser(rollups), period)
+    os.makedirs(directory, exist_ok=True)
+    for level, table in tables.items():
+        path = os.path.join(directory, level + ".parquet")
+        table.to_parquet(path + ".tmp")
+        os.replace(path + ".tmp", path)
+    return directory
+
+# Read one level's table, optionally only the rows for some keys.
+# Keys are matched against the first column of the level's index.
+def readrollup(rollups, period, level, keys=None):
+    gold_store.checkparquet()
+    path = os.path.join(os.path.expanduser(rollups), period, level + ".parquet")
+    if not os.path.exists(path):
+        return None
+    table = pandas.read_parquet(path)
+    if keys is not None:
+        table = table[table.index.get_level_values(0).isin(keys)]
+    return table
+
+
+# Put main in a function so it is importable.
+def main(argv):
+
+    try:
+        args = getargs(argv)
+    except ValueError as err:
+        print(err)
+        exit(1)
+
+    if args.ingest:
+        usage = readcharges(sys.stdin, args.chunksize)
+        if usage.empty:
+            print("No charges found in input, nothing stored.", file=sys.stderr)
+            exit(1)
+        tables = rollup(addhierarchy(usage, readconsortia(args.consortia)))
+        directory = writerollups(args.rollups, args.period, tables)
+        if args.verbose:
+            print("Rolled up " + str(int(usage['Transactions'].sum())) + " charges into " + directory)
+
+    if args.show is not None:
+        table = readrollup(args.rollups, args.period, args.show, args.key)
+        if table is None:
+            print("No rollups for period " + args.period + " in " + args.rollups)
+            exit(1)
+        # write out as csv, keeping the index columns
+        if args.csvfile is not None:
+            table.to_csv(args.csvfile)
+        else:
+            pandas.set_option('display.max_rows', None)
+            print(table)
+# end main
+
+# When not imported, use the normal global arguments
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,77 @@
+# Local cache of the SAFE ticket feed.
+
+# Stores the last payload from SAFE with the time it was fetched, a hash of
+# its contents and the ETag/Last-Modified validators SAFE sent, so that the
+# next request can be conditional. It also remembers the hash of the payload
+# that was last refreshed into our DB, so an unchanged feed does not need
+# to be decoded or upserted again.
+
+# The cache holds personal data and ssh keys, so it is only readable by its owner.
+
+import os
+import json
+import time
+import hashlib
+
+DEFAULT_CACHE_FILE = "~/.safetickets_cache.json"
+
+# Read the cache, returning an empty dict if there isn't a usable one
+def load(filename):
+    try:
+        with open(os.path.expanduser(filename), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Write the cache atomically so a concurrent reader never sees half a file
+def save(filename, cache):
+    path = os.path.expanduser(filename)
+    tmppath = path + ".tmp"
+    fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmppath, path)
+
+def payloadhash(payload):
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+# Headers that make the request conditional on the cached payload
+def conditionalheaders(cache):
+    headers = {}
+    if 'payload' not in cache:
+        return headers
+    if cache.get('etag'):
+        headers['If-None-Match'] = cache['etag']
+    if cache.get('last_modified'):
+        headers['If-Modified-Since'] = cache['last_modified']
+    return headers
+
+# Is there a cached payload fetched less than max_age seconds ago
+def isfresh(cache, max_age):
+    if 'payload' not in cache:
+        return False
+    return time.time() - cache.get('fetched', 0) <= max_age
+
+# Store a newly-fetched payload and its validators
+def storepayload(cache, payload, headers):
+    cache['payload'] = payload
+    cache['hash'] = payloadhash(payload)
+    cache['etag'] = headers.get('ETag')
+    cache['last_modified'] = headers.get('Last-Modified')
+    cache['fetched'] = time.time()
+    return cache
+
+# SAFE said the cached payload is still current
+def revalidated(cache):
+    cache['fetched'] = time.time()
+    return cache
+
+# Has the cached payload already been refreshed into our DB
+def isrefreshed(cache):
+    return 'hash' in cache and cache.get('refreshed') == cache['hash']
+
+# Remember that the payload with this hash is now in our DB
+def markrefreshed(filename, payload_hash):
+    cache = load(filename)
+    cache['refreshed'] = payload_hash
+    save(filename, cache)
@@ -2,13 +2,23 @@
 
 import os.path
 import sys
+import json
+import time
 import configparser
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
+DEFAULT_SNAPSHOT = "~/.safegold_snapshot.json"
+
 def getargs(argv):
     parser = argparse.ArgumentParser(description="Update Gold in SAFE.")
     parser.add_argument("--uploadgold", dest="goldstdin", help="Upload Gold balances from stdin, input formed from glsalloc --raw", action='store_true')
+    parser.add_argument("--full", help="Upload every allocation, not just those changed since the last upload", action='store_true')
+    parser.add_argument("--snapshot", dest="snapshot", default=DEFAULT_SNAPSHOT, help="File holding the last uploaded state of each allocation")
+    parser.add_argument("--chunk-size", dest="chunksize", type=int, default=1000, help="Number of lines to send in each post (default 1000)")
+    parser.add_argument("--workers", dest="workers", type=int, default=4, help="Number of chunks to post at once (default 4)")
+    parser.add_argument("--retries", dest="retries", type=int, default=3, help="Number of times to retry a failed chunk (default 3)")
     parser.add_argument("--verbose", help="", action='store_true')
     parser.add_argument("--debug", help="", action='store_true')
 
@@ -23,26 +33,111 @@ def getargs(argv):
 # end getargs
 
 
-# Post the data to SAFE using our credentials
-def senddata(config, args, golddata):
+# The snapshot maps allocation Id to [Amount, Deposited] as last confirmed by SAFE
+def readsnapshot(filename):
+    try:
+        with open(os.path.expanduser(filename), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Write the snapshot atomically so an interrupted run can't leave half a file
+def writesnapshot(filename, snapshot):
+    path = os.path.expanduser(filename)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(path + ".tmp", path)
+
+# Get the snapshot key and value for a glsalloc --raw line:
+# Id|Account|Projects|StartTime|EndTime|Amount|Deposited|Description
+# Returns None for lines we can't parse, which are always sent.
+def allocationstate(line):
+    fields = line.rstrip("\n").split("|")
+    if len(fields) < 7 or isheader(line):
+        return None
+    return (fields[0], [fields[5], fields[6]])
+
+# glsalloc --raw starts with a header line naming the columns
+def isheader(line):
+    return line.split("|")[0] == "Id"
+
+# Work out which lines to send: all of them with --full, otherwise only
+# allocations that are new or whose Amount/Deposited changed. The header
+# line is kept at the front if anything else is sent, and never counts as
+# a change on its own.
+# Returns a list of (line, state) tuples.
+def selectlines(lines, snapshot, full):
+    header = [(line, None) for line in lines if isheader(line)]
+    selected = []
+    for line in lines:
+        if isheader(line):
+            continue
+        state = allocationstate(line)
+        if full or state is None or snapshot.get(state[0]) != state[1]:
+            selected.append((line, state))
+    if len(selected) == 0:
+        return []
+    return header[:1] + selected
+
+# A session whose connection pool is big enough for all the workers
+def getsession(config, workers):
+    session = requests.Session()
+    session.auth = (config['safe']['user'], config['safe']['password'])
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Post the data to SAFE using our credentials, retrying on failure.
+# Returns True once SAFE confirms it received the lines.
+def senddata(session, config, args, golddata):
     postdata = {'table':'GoldAllocations', 'mode':'upload', 'machine_name':'Thomas', 'update':golddata}
     if args.debug:
         print("Post request would be to " + config['safe']['gold'] + " with data = " + str(postdata))
-    else:
-        request = requests.post(config['safe']['gold'], auth = (config['safe']['user'], config['safe']['password']), data = postdata)
+        return True
+    for attempt in range(args.retries + 1):
+        # back off a little more each time
+        if attempt > 0:
+            time.sleep(2 ** attempt)
+        try:
+            request = session.post(config['safe']['gold'], data = postdata)
+        except requests.exceptions.RequestException as err:
+            print("Posting to SAFE failed (attempt " + str(attempt + 1) + "): " + str(err))
+            continue
         if "Total lines:" in request.text:
             print("Gold allocations successfully posted: \n" + request.text)
-        else:
-            print("Posting to SAFE failed: \n" + request.text)
-            exit(1)
+            return True
+        print("Posting to SAFE failed (attempt " + str(attempt + 1) + "): \n" + request.text)
+    return False
 # end senddata
 
 
+# Send the selected lines in chunks, several at once. The snapshot is only
+# updated with the allocations in chunks that SAFE confirmed.
+# Returns True if every chunk was confirmed.
+def uploadgold(config, args, selected, snapshot):
+    chunks = [selected[i:i + args.chunksize] for i in range(0, len(selected), args.chunksize)]
+    session = getsession(config, args.workers)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        # need the data as one string, not a list of strings
+        results = executor.map(lambda chunk: senddata(session, config, args, "".join(line for line, _ in chunk)), chunks)
+        confirmed = list(results)
+
+    for chunk, ok in zip(chunks, confirmed):
+        if ok:
+            for _, state in chunk:
+                if state is not None:
+                    snapshot[state[0]] = state[1]
+    if not args.debug:
+        writesnapshot(args.snapshot, snapshot)
+    return all(confirmed)
+# end uploadgold
+
+
 # Put main in a function so it is importable.
 def main(argv):
 
-    MAX_DATA = 1000
-
     try:
         args = getargs(argv)
         # make a dictionary from args to make string substitutions doable by key name
@@ -50,6 +145,9 @@ def main(argv):
     except ValueError as err:
         print(err)
         exit(1)
+    if args.chunksize < 1 or args.workers < 1 or args.retries < 0:
+        print("--chunk-size and --workers must be at least 1 and --retries at least 0.")
+        exit(1)
     # parse our credentials
     try:
         config = configparser.ConfigParser()
@@ -59,20 +157,18 @@ def main(argv):
 
     # Update Gold allocations from pipe-separated stdin input
     if args.goldstdin:
-        # read in chunks of 1000 lines, send
-        data = []
-        for line in sys.stdin:
-            # filter out Faraday allocations
-            if "|Faraday" not in line:
-                data.append(line)
-            if len(data) == MAX_DATA:
-                # need the data as one string, not a list of strings
-                datastring = "".join(data)
-                senddata(config, args, datastring)
-                data = []
-        # send the leftover chunk of lines
-        datastring = "".join(data)
-        senddata(config, args, datastring)
+        # filter out Faraday allocations
+        lines = [line for line in sys.stdin if "|Faraday" not in line]
+        snapshot = readsnapshot(args.snapshot)
+        selected = selectlines(lines, snapshot, args.full)
+        if args.verbose:
+            print(str(len(selected)) + " of " + str(len(lines)) + " allocations to upload.")
+        if len(selected) == 0:
+            print("No Gold allocations changed since the last upload.")
+            return
+        if not uploadgold(config, args, selected, snapshot):
+            print("Some Gold allocations could not be posted to SAFE.")
+            exit(1)
 
 
 # end main
@@ -80,4 +176,3 @@ def main(argv):
 # When not imported, use the normal global arguments
 if __name__ == "__main__":
     main(sys.argv[1:])
-
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+# Record/replay harness and benchmark for SAFE ticket handling.
+
+# Replays a recorded SAFE ticket feed from a local HTTP stand-in for SAFE,
+# which also accepts the updateticket posts, and drives --refresh and bulk
+# closing of every pending ticket against a local database. Anything that
+# would change a real cluster (account creation, Gold transfers, ssh keys,
+# AD lookups) is replaced by a stub that just records the call.
+
+# Needs a local copy of the thomas database schema. Its connection details
+# go in their own option group in ~/.thomas.cnf, eg:
+#   [thomas_replay]
+#   host=localhost
+#   user=...
+#   password=...
+# Points of contact in the local database should be unambiguous, or
+# Add to budget tickets will stop and ask which one to use.
+
+import os.path
+import sys
+import time
+import json
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import resource
+import configparser
+import socketserver
+import urllib.parse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import mysql.connector
+from mysql.connector import errorcode
+import requests
+import thomas_queries
+import thomas_utils
+import thomas_create
+import safe_feed_cache as feedcache
+import safe_tickets
+
+# The handlers we report latency for
+HANDLERS = ["newuser", "newbudget", "addtobudget", "movegold", "updateaccount"]
+
+# Never replay into the live databases
+LIVE_DATABASES = ["thomas", "young"]
+
+def getargs(argv):
+    parser = argparse.ArgumentParser(description="Record SAFE tickets, or replay recorded tickets against a local database and benchmark their handling.")
+    parser.add_argument("--record", dest="recordfile", default=None, help="Save the current SAFE ticket feed as JSON to this file and exit")
+    parser.add_argument("-f", "--file", dest="jsonfile", default=None, help="Recorded JSON ticket feed to replay")
+    parser.add_argument("--database", dest="database", default="thomas_replay", help="Local database to replay into (default thomas_replay)")
+    parser.add_argument("--option-group", dest="optiongroup", default="thomas_replay", help="Option group in ~/.thomas.cnf for the local database")
+    parser.add_argument("--cluster", dest="cluster", default="thomas", help="Cluster the replay pretends to be running on")
+    parser.add_argument("--refreshes", dest="refreshes", type=int, default=1, help="Number of times to refresh the tickets into the database")
+    parser.add_argument("--noclose", help="Only refresh, don't close the pending tickets", action='store_true')
+    parser.add_argument("--commit", help="Commit the replayed changes to the local database (default is to roll back)", action='store_true')
+    parser.add_argument("--quiet", help="Hide the output from the ticket handlers", action='store_true')
+
+    # Show the usage if no arguments are supplied
+    if len(argv) < 1:
+        parser.print_usage()
+        exit(1)
+
+    return parser.parse_args(argv)
+# end getargs
+
+
+# Save the live SAFE feed, exactly as received, to replay later
+def recordfeed(config, filename):
+    request = requests.get(config['safe']['host'] + "?mode=json", auth = (config['safe']['user'], config['safe']['password']))
+    if request.status_code != 200:
+        print("Request not successful, code " + str(request.status_code))
+        exit(1)
+    with open(filename, 'w') as f:
+        f.write(request.text)
+    print("Recorded " + str(len(safe_tickets.decoder.JSONtoTickets(request.text))) + " tickets to " + filename)
+
+
+###########################
+#                         #
+# Local stand-in for SAFE #
+#                         #
+###########################
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+# Serves the recorded feed on GET (with an ETag, so conditional requests
+# work as they do against SAFE) and accepts any updateticket POST.
+class FakeSAFEHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        payload = self.server.payload
+        etag = '"' + feedcache.payloadhash(payload) + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = payload.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        query = urllib.parse.urlparse(self.path).query
+        self.server.posts.append(dict(urllib.parse.parse_qsl(query)))
+        body = b"<html><head><title>SysAdminServlet Success</title></head></html>"
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # keep the request log out of the benchmark output
+    def log_message(self, format, *args):
+        pass
+
+def startfakesafe(payload):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSAFEHandler)
+    server.payload = payload
+    server.posts = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+# Config pointing safe_tickets at the stand-in
+def fakeconfig(server):
+    config = configparser.ConfigParser()
+    config['safe'] = {'host': "http://127.0.0.1:" + str(server.server_address[1]) + "/",
+                      'user': "replay",
+                      'password': "replay"}
+    return config
+
+
+##################################
+#                                #
+# Stubs and per-handler timings  #
+#                                #
+##################################
+
+# Replace everything that would touch the cluster, Gold or AD with stubs
+# that record their arguments. Returns the list of recorded calls.
+def installstubs(cluster):
+    calls = []
+    mmm_counter = [9000]
+
+    def stub(name, result=None):
+        def recorded(*args, **kwargs):
+            calls.append((name, args))
+            return result
+        return recorded
+
+    def nextmmm(cursor):
+        mmm_counter[0] += 1
+        return 'mmm' + '{0:04}'.format(mmm_counter[0] % 10000)
+
+    thomas_create.createaccount = stub('createaccount')
+    thomas_utils.transfergold = stub('transfergold')
+    thomas_utils.refreshSAFEgold = stub('refreshSAFEgold')
+    thomas_utils.addsshkey = stub('addsshkey')
+    thomas_utils.getnodename = lambda: cluster
+    thomas_utils.getunusedmmm = nextmmm
+    thomas_utils.AD_username_from_email = lambda config, email: email.partition("@")[0][:7]
+    return calls
+
+# Wrap each safe_tickets handler so every call records how long it took
+def timehandlers(timings):
+    for name in HANDLERS:
+        handler = getattr(safe_tickets, name)
+        timings[name] = []
+
+        def timed(*args, _handler=handler, _name=name, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _handler(*args, **kwargs)
+            finally:
+                timings[_name].append(time.perf_counter() - start)
+        setattr(safe_tickets, name, timed)
+
+
+##########################
+#                        #
+# Replay and benchmark   #
+#                        #
+##########################
+
+# Close every pending ticket in the local database, oldest id first.
+# A New User ticket also closes its matching Add to budget ticket, so
+# check each one is still pending before closing it.
+def closeall(cursor, config, args):
+    cursor.execute(thomas_queries.showpendingtickets())
+    pending = [str(t['id']) for t in cursor.fetchall()]
+    closed = 0
+    for ticket in sorted(pending, key=int):
+        cursor.execute(thomas_queries.safeticketstatus(), {'id':ticket})
+        result = cursor.fetchall()
+        if len(result) == 0 or result[0]['status'] != 'Pending':
+            continue
+        safe_tickets.closeticket(cursor, config, args, ticket)
+        closed += 1
+    return closed
+
+def replay(cursor, config, args, timings):
+    # the arguments the safe_tickets functions expect from its own parser
+    ticketargs = argparse.Namespace(debug=False, max_age=None, cachefile=None)
+    results = {}
+
+    # time the refreshes, with an empty feed cache each time so every one
+    # decodes and upserts the whole feed
+    with tempfile.TemporaryDirectory() as tmpdir:
+        elapsed = 0.0
+        tickets = 0
+        for i in range(args.refreshes):
+            ticketargs.cachefile = os.path.join(tmpdir, "cache" + str(i) + ".json")
+            start = time.perf_counter()
+            safe_tickets.refreshtickets(cursor, config, ticketargs)
+            elapsed += time.perf_counter() - start
+            tickets += len(safe_tickets.decodetickets(feedcache.load(ticketargs.cachefile)))
+        results['refresh'] = (tickets, elapsed)
+
+    if not args.noclose:
+        start = time.perf_counter()
+        closed = closeall(cursor, config, ticketargs)
+        results['close'] = (closed, time.perf_counter() - start)
+    return results
+
+def printreport(results, timings, calls, posts, peak_memory):
+    print("Benchmark results:")
+    rows = []
+    for stage, (tickets, elapsed) in results.items():
+        rate = tickets / elapsed if elapsed > 0 else float('nan')
+        rows.append({'stage': stage, 'tickets': tickets, 'seconds': elapsed, 'tickets/s': rate})
+    thomas_utils.tableprint_dict(rows)
+
+    rows = []
+    for name in HANDLERS:
+        times = sorted(timings[name])
+        if len(times) == 0:
+            continue
+        rows.append({'handler': name,
+                     'calls': len(times),
+                     'mean ms': 1000 * sum(times) / len(times),
+                     'median ms': 1000 * times[len(times) // 2],
+                     'max ms': 1000 * times[-1]})
+    if len(rows) > 0:
+        thomas_utils.tableprint_dict(rows)
+
+    print("SAFE updateticket posts: " + str(len(posts)))
+    print("Stubbed external calls: " + str(len(calls)))
+    print("Peak traced Python memory: %.1f MiB" % (peak_memory / (1024 * 1024)))
+    # ru_maxrss is in kilobytes on Linux
+    print("Max resident set size: %.1f MiB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+# Put main in a function so it is importable.
+def main(argv):
+
+    try:
+        args = getargs(argv)
+    except ValueError as err:
+        print(err)
+        exit(1)
+
+    if args.recordfile is not None:
+        config = configparser.ConfigParser()
+        config.read_file(open(os.path.expanduser('~/.thomas.cnf')))
+        recordfeed(config, args.recordfile)
+        return
+
+    if args.jsonfile is None:
+        print("No recorded ticket feed was specified, use -f FILE.")
+        exit(1)
+    if args.database in LIVE_DATABASES:
+        print("Refusing to replay tickets into the live " + args.database + " database.")
+        exit(1)
+
+    with open(args.jsonfile, 'r') as f:
+        payload = f.read()
+    # fail early on a bad recording
+    json.loads(payload)
+
+    server = startfakesafe(payload)
+    config = fakeconfig(server)
+    calls = installstubs(args.cluster)
+    timings = {}
+    timehandlers(timings)
+
+    try:
+        conn = mysql.connector.connect(option_files=os.path.expanduser('~/.thomas.cnf'), option_groups=args.optiongroup, database=args.database)
+        cursor = conn.cursor(dictionary=True)
+
+        tracemalloc.start()
+        if args.quiet:
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+        try:
+            results = replay(cursor, config, args, timings)
+        finally:
+            if args.quiet:
+                sys.stdout.close()
+                sys.stdout = stdout
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        if args.commit:
+            conn.commit()
+        else:
+            conn.rollback()
+
+    except mysql.connector.Error as err:
+        if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
+            print("Access denied: Something is wrong with your user name or password")
+        elif err.errno == errorcode.ER_BAD_DB_ERROR:
+            print("Database does not exist")
+        else:
+            print(err)
+        exit(1)
+    else:
+        cursor.close()
+        conn.close()
+    finally:
+        server.shutdown()
+
+    printreport(results, timings, calls, server.posts, peak_memory)
+# end main
+
+# When not imported, use the normal global arguments
+if __name__ == "__main__":
+    main(sys.argv[1:])
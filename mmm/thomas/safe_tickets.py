@@ -9,6 +9,7 @@ from mysql.connector import errorcode
 import json
 import requests
 import safe_json_decoder as decoder
+import safe_feed_cache as feedcache
 import thomas_queries
 import thomas_utils
 import thomas_create
@@ -20,6 +21,10 @@ def getargs(argv):
     parser.add_argument("-r", "--refresh", dest="refresh", help="Refresh open tickets in DB from SAFE and display them", action='store_true')
     parser.add_argument("-c", "--close", dest="close", default=None, help="Carry out and close this ticket ID")
     parser.add_argument("--reject", dest="reject", default=None, help="Reject this ticket ID")
+    parser.add_argument("--changes-since", dest="changes_since", type=int, default=None, metavar="CHECKPOINT", help="Show ticket events (added, changed, closed) recorded after this checkpoint (0 for all)")
+    parser.add_argument("--checkpoint-file", dest="checkpointfile", default=None, help="With --changes-since, write the latest checkpoint to this file")
+    parser.add_argument("--max-age", dest="max_age", type=int, default=None, metavar="SECONDS", help="With --show, use the cached tickets if they were fetched from SAFE less than this many seconds ago")
+    parser.add_argument("--cache-file", dest="cachefile", default=feedcache.DEFAULT_CACHE_FILE, help="Location of the local SAFE ticket feed cache")
     parser.add_argument("--debug", help="Show what would be submitted without committing the change", action='store_true')
 
     # Show the usage if no arguments are supplied
@@ -41,27 +46,40 @@ def parsejsonfile(filename):
         print(str(t.Ticket))
     print("Number of tickets included: " + str(len(ticketlist)))
 
-# Connect to SAFE, get open tickets as JSON
-def getopentickets(config):
-    request = requests.get(config['safe']['host'] + "?mode=json", auth = (config['safe']['user'], config['safe']['password']))
-    if request.status_code == 200:
-        try:
-            data = request.json()
-            return data
-        except json.decoder.JSONDecodeError as _:
-            print("Received invalid json, contents: " + str(request.content))
-            exit(1)
+# Connect to SAFE, get open tickets as JSON text.
+# Uses a conditional request against the local feed cache, and with
+# args.max_age serves the cached payload without contacting SAFE at all.
+# Returns the updated cache, which includes the payload and its hash.
+def getopentickets(config, args):
+    cache = feedcache.load(args.cachefile)
+    if args.max_age is not None and feedcache.isfresh(cache, args.max_age):
+        return cache
+    request = requests.get(config['safe']['host'] + "?mode=json", auth = (config['safe']['user'], config['safe']['password']), headers = feedcache.conditionalheaders(cache))
+    if request.status_code == 304:
+        cache = feedcache.revalidated(cache)
+    elif request.status_code == 200:
+        cache = feedcache.storepayload(cache, request.text, request.headers)
     else:
         print("Request not successful, code " + str(request.status_code))
-
+        exit(1)
+    feedcache.save(args.cachefile, cache)
+    return cache
 # end getopentickets
 
-def gettickets(config):
+# Decode the cached payload into a list of tickets
+def decodetickets(cache):
+    try:
+        jsontickets = json.loads(cache['payload'])
+    except json.decoder.JSONDecodeError as _:
+        print("Received invalid json, contents: " + cache['payload'])
+        exit(1)
+    # parse SAFE tickets
+    return decoder.JSONDataToTickets(jsontickets)
+
+def gettickets(config, args):
         # get SAFE tickets
-        jsontickets = getopentickets(config)
-        # parse SAFE tickets
-        ticketlist = decoder.JSONDataToTickets(jsontickets)
-        return ticketlist
+        cache = getopentickets(config, args)
+        return decodetickets(cache)
 # end gettickets
 
 # Update and complete a budget (project) ticket
@@ -101,10 +119,49 @@ def updateticket(config, args, parameters):
     else:
         request = requests.post(config['safe']['host'], auth = (config['safe']['user'], config['safe']['password']), params = parameters)
         if "<title>SysAdminServlet Success</title>" in request.text:
-            print("Ticket " + parameters['qtid'] + " closed.")
+            print("Ticket " + str(parameters['qtid']) + " closed.")
 # end updateticket
 
 
+# Record an added/changed/closed event for this ticket in the ticket history
+def recordticketevent(cursor, args, ticketid, status, event):
+    cursor.execute(thomas_queries.addsafeticketevent(), {'id':ticketid, 'status':status, 'event':event})
+    thomas_utils.debugcursor(cursor, args.debug)
+
+# Set the status of a ticket in our DB once we have dealt with it, and record it as closed
+def updatesafestatus(cursor, args, ticketid, status):
+    cursor.execute(thomas_queries.updatesafestatus(), {'id':ticketid, 'status':status})
+    thomas_utils.debugcursor(cursor, args.debug)
+    recordticketevent(cursor, args, ticketid, status, 'closed')
+
+# Work out if a ticket from SAFE is new to our DB or has changed status.
+# Returns the event to record, or None if nothing changed.
+def refreshevent(cursor, ticket):
+    cursor.execute(thomas_queries.safeticketstatus(), {'id':ticket['id']})
+    result = cursor.fetchall()
+    if len(result) == 0:
+        return 'added'
+    elif result[0]['status'] != ticket['status']:
+        return 'changed'
+    return None
+
+# Show the ticket events recorded after the checkpoint and optionally save
+# the new checkpoint. Prints nothing if there were no events, so the output
+# can be used directly as a notification body.
+def showchanges(cursor, args):
+    cursor.execute(thomas_queries.safeticketchanges(), {'checkpoint':args.changes_since})
+    events = cursor.fetchall()
+    if len(events) > 0:
+        thomas_utils.tableprint_dict(events)
+        checkpoint = events[-1]['event_id']
+    else:
+        checkpoint = args.changes_since
+    if args.checkpointfile is not None:
+        with open(args.checkpointfile, 'w') as f:
+            f.write(str(checkpoint) + "\n")
+# end showchanges
+
+
 # Deal with a New User ticket
 # (thomas_utils and thomas_create commands that add and create users contain debugging).
 def newuser(cursor, config, args, ticketid):
@@ -155,7 +212,7 @@ def newuser(cursor, config, args, ticketid):
     # update SAFE and close the ticket
     updateticket(config, args, updatenewuser(ticketid, user_dict['username']))
     # update ticket status in our DB
-    cursor.execute(thomas_queries.updatesafestatus(), {'id':ticketid, 'status':'Completed'})
+    updatesafestatus(cursor, args, ticketid, 'Completed')
 # end newuser
 
 
@@ -180,7 +237,7 @@ def newbudget(cursor, config, args, ticketid):
     # update SAFE and close the ticket
     updateticket(config, args, updatebudget(ticketid, budget_dict['project_ID']))
     # update ticket status in our DB
-    cursor.execute(thomas_queries.updatesafestatus(), {'id':ticketid, 'status':'Completed'})
+    updatesafestatus(cursor, args, ticketid, 'Completed')
 # end newbudget
 
 
@@ -207,7 +264,7 @@ def addtobudget(cursor, config, args, ticketid):
     # update SAFE and close the ticket
     updateticket(config, args, updategeneric(ticketid))
     # update ticket status in our DB
-    cursor.execute(thomas_queries.updatesafestatus(), {'id':ticketid, 'status':'Completed'})
+    updatesafestatus(cursor, args, ticketid, 'Completed')
 # end addtobudget
 
 
@@ -253,7 +310,7 @@ def updateaccount(cursor, config, args, ticketid):
     # update SAFE and close the ticket
     updateticket(config, args, updategeneric(ticketid))
     # update ticket status in our DB
-    cursor.execute(thomas_queries.updatesafestatus(), {'id':ticketid, 'status':'Completed'})
+    updatesafestatus(cursor, args, ticketid, 'Completed')
 # end updateaccount
 
 
@@ -274,7 +331,7 @@ def movegold(cursor, config, args, ticketid):
     # update SAFE and close the ticket
     updateticket(config, args, updategeneric(ticketid))
     # update ticket status in our DB
-    cursor.execute(thomas_queries.updatesafestatus(), {'id':ticketid, 'status':'Completed'})
+    updatesafestatus(cursor, args, ticketid, 'Completed')
 # end movegold
 
 
@@ -307,6 +364,80 @@ def ticketstodicts(ticketlist):
     return ticket_dicts
 
 
+# Refresh the tickets in our DB from SAFE and show the pending ones.
+# Returns the hash of the payload that was upserted, or None if the DB
+# already had it.
+def refreshtickets(cursor, config, args):
+    refreshedhash = None
+    # refresh always asks SAFE, never just the cache
+    args.max_age = None
+    cache = getopentickets(config, args)
+    # nothing to do if this payload is already in the database
+    if feedcache.isrefreshed(cache):
+        print("SAFE tickets unchanged since last refresh.")
+    else:
+        # get SAFE tickets as list of dicts
+        ticketdicts = ticketstodicts(decodetickets(cache))
+        # refresh tickets in database
+        for t in ticketdicts:
+            # work out the history event before the ticket is updated
+            event = refreshevent(cursor, t)
+            cursor.execute(thomas_queries.refreshsafetickets(), t)
+            thomas_utils.debugcursor(cursor, args.debug)
+            if event is not None:
+                recordticketevent(cursor, args, t['id'], t['status'], event)
+        refreshedhash = cache['hash']
+    # show database tickets (not inc ssh key)
+    print("Refreshed tickets:")
+    cursor.execute(thomas_queries.showpendingtickets())
+    thomas_utils.tableprint_dict(cursor.fetchall())
+    return refreshedhash
+# end refreshtickets
+
+
+# Carry out and close this ticket ID, using the handler for its type
+def closeticket(cursor, config, args, ticket):
+    # get the type of ticket - ticket id is unique so there is only one
+    # (Either make a temporary dict or pass in (ticket,) with the comma which is ugly).
+    cursor.execute(thomas_queries.safetickettype(), {'id':ticket})
+    result = cursor.fetchall()
+    # make sure we got a result, or exit
+    if cursor.rowcount < 1:
+        print("No tickets with id " + ticket + " found, exiting.")
+        exit(1)
+
+    tickettype = result[0]['type']
+    # store all the ticket info
+
+    # new user
+    if tickettype == "New User":
+        newuser(cursor, config, args, ticket)
+        # Each new user ticket should have a matching Add to budget ticket.
+        # Find it if it exists and complete it too.
+        match = matchbudgetticket(cursor, ticket)
+        if match is not None:
+            print("Matching 'Add to budget' ticket " + str(match['ticket_ID'])  +  " found for this new user, carrying out.")
+            addtobudget(cursor, config, args, match['ticket_ID'])
+
+    # new budget
+    elif tickettype == "New Budget":
+        newbudget(cursor, config, args, ticket)
+    # add to budget
+    elif tickettype == "Add to budget":
+        addtobudget(cursor, config, args, ticket)
+    # update account info
+    elif tickettype == "Update account":
+        updateaccount(cursor, config, args, ticket)
+    # move Gold and refresh SAFE
+    elif tickettype == "Move gold":
+        movegold(cursor, config, args, ticket)
+        thomas_utils.refreshSAFEgold(args)
+    else:
+        print("Ticket " + ticket + " type unrecognised: " + tickettype)
+        exit(1)
+# end closeticket
+
+
 # Put main in a function so it is importable.
 def main(argv):
 
@@ -329,7 +460,7 @@ def main(argv):
     # Show tickets live from SAFE
     if args.show:
         # get SAFE tickets
-        ticketlist = gettickets(config)
+        ticketlist = gettickets(config, args)
 
         # print SAFE tickets
         for t in ticketlist:
@@ -339,66 +470,19 @@ def main(argv):
         print("Number of pending tickets: " + str(len(ticketlist)))
 
     # these options require a database connection
-    if args.refresh or args.close is not None or args.reject is not None:
+    if args.refresh or args.close is not None or args.reject is not None or args.changes_since is not None:
         try:
             conn = mysql.connector.connect(option_files=os.path.expanduser('~/.thomas.cnf'), option_groups='thomas_update', database='thomas')
             cursor = conn.cursor(dictionary=True)
 
             # Refresh the database tickets
+            refreshedhash = None
             if args.refresh:
-                # get SAFE tickets as list of dicts
-                ticketdicts = ticketstodicts(gettickets(config))
-                # refresh tickets in database
-                for t in ticketdicts:
-                    cursor.execute(thomas_queries.refreshsafetickets(), t)
-                    thomas_utils.debugcursor(cursor, args.debug)
-                # show database tickets (not inc ssh key)
-                print("Refreshed tickets:")
-                cursor.execute(thomas_queries.showpendingtickets())
-                thomas_utils.tableprint_dict(cursor.fetchall())
+                refreshedhash = refreshtickets(cursor, config, args)
     
             # Update and close SAFE tickets
             if args.close is not None:
-                # for readability below
-                ticket = args.close
-                # get the type of ticket - ticket id is unique so there is only one
-                # (Either make a temporary dict or pass in (ticket,) with the comma which is ugly).
-                cursor.execute(thomas_queries.safetickettype(), {'id':ticket})
-                result = cursor.fetchall()
-                # make sure we got a result, or exit
-                if cursor.rowcount < 1:
-                    print("No tickets with id " + ticket + " found, exiting.")
-                    exit(1)
-
-                tickettype = result[0]['type']
-                # store all the ticket info
-
-                # new user
-                if tickettype == "New User":
-                    newuser(cursor, config, args, ticket)
-                    # Each new user ticket should have a matching Add to budget ticket.
-                    # Find it if it exists and complete it too.
-                    match = matchbudgetticket(cursor, ticket)
-                    if match is not None:
-                        print("Matching 'Add to budget' ticket " + str(match['ticket_ID'])  +  " found for this new user, carrying out.")
-                        addtobudget(cursor, config, args, match['ticket_ID'])
-
-                # new budget
-                elif tickettype == "New Budget":
-                    newbudget(cursor, config, args, ticket)
-                # add to budget
-                elif tickettype == "Add to budget":
-                    addtobudget(cursor, config, args, ticket)
-                # update account info
-                elif tickettype == "Update account":
-                    updateaccount(cursor, config, args, ticket)
-                # move Gold and refresh SAFE
-                elif tickettype == "Move gold":
-                    movegold(cursor, config, args, ticket)
-                    thomas_utils.refreshSAFEgold(args)
-                else:
-                    print("Ticket " + ticket + " type unrecognised: " + tickettype)
-                    exit(1)
+                closeticket(cursor, config, args, args.close)
                  
             # Reject SAFE tickets - there are two types of rejection so ask
             if args.reject is not None:
@@ -407,16 +491,26 @@ def main(argv):
                 if answer == "error":
                     updateticket(config, args, rejecterror(ticket))
                     # update ticket status in our DB
-                    cursor.execute(thomas_queries.updatesafestatus(), {'id':ticket, 'status':'Error'})
+                    updatesafestatus(cursor, args, ticket, 'Error')
 
                 else:
                     updateticket(config, args, rejectother(ticket))
                     # update ticket status in our DB
-                    cursor.execute(thomas_queries.updatesafestatus(), {'id':ticket, 'status':'Refused'})
+                    updatesafestatus(cursor, args, ticket, 'Refused')
+
+            # Show ticket events since the given checkpoint
+            if args.changes_since is not None:
+                showchanges(cursor, args)
 
             # commit the change to the database unless we are debugging
             if not args.debug:
                 conn.commit()
+                # only now is the refreshed payload really in the database
+                if refreshedhash is not None:
+                    feedcache.markrefreshed(args.cachefile, refreshedhash)
+                # we changed ticket statuses, so the next refresh must upsert again
+                if args.close is not None or args.reject is not None:
+                    feedcache.markrefreshed(args.cachefile, None)
 
         except mysql.connector.Error as err:
             if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
@@ -118,6 +118,17 @@ def updatesafestatus():
                 WHERE id=%(id)s""")
     return query
 
+# Record an added/changed/closed event for a SAFE ticket in the ticket history.
+# safeticket_history has an auto-increment event_id which is used as the
+# checkpoint by safetickets --changes-since:
+#   CREATE TABLE safeticket_history (event_id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+#     ticket_id INT NOT NULL, status VARCHAR(32), event VARCHAR(16), event_date DATETIME,
+#     KEY (ticket_id));
+def addsafeticketevent():
+    query = ("""INSERT INTO safeticket_history SET ticket_id=%(id)s, status=%(status)s, 
+                 event=%(event)s, event_date=now()""")
+    return query
+
 ######################################################
 #                                                    #
 # Queries that insert/update entries in the database #
@@ -317,6 +328,23 @@ def showpendingtickets():
                 WHERE status='Pending'""")
     return query
 
+# Get the current status of a SAFE ticket
+def safeticketstatus():
+    query = ("""SELECT id, status 
+                FROM safetickets 
+                WHERE id=%(id)s""")
+    return query
+
+# Get all ticket history events after this checkpoint (event_id), oldest first
+def safeticketchanges():
+    query = ("""SELECT event_id, event, ticket_id, safeticket_history.status, type, 
+                  account_name, project, event_date
+                FROM safeticket_history
+                  INNER JOIN safetickets ON safeticket_history.ticket_id = safetickets.id
+                WHERE event_id > %(checkpoint)s
+                ORDER BY event_id""")
+    return query
+
 # Get the type of a SAFE ticket
 def safetickettype():
     query = ("""SELECT type 
@@ -333,6 +361,14 @@ def getsafeticket():
                 WHERE id=%(id)s""")
     return query
 
+# Get all completed 'Move gold' tickets, for reconciling against Gold
+def completedgoldtickets():
+    query = ("""SELECT id, project, source_account_id, source_allocation, gold_amount
+                FROM safetickets 
+                WHERE status='Completed'
+                  AND type='Move gold'""")
+    return query
+
 # Get all open 'Add to budget' tickets belonging to this user
 def getusersbudgettickets():
     query = ("""SELECT id, type, status, account_name, machine, project, firstname, lastname, 
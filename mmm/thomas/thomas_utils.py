@@ -2,8 +2,8 @@
 
 from tabulate import tabulate
 from ldap3 import Server, Connection, ALL
-import socket
 import thomas_queries
+import cluster_identity
 import validate
 import subprocess
 import sys
@@ -250,35 +250,21 @@ def checkprojectoncluster(project, nodename):
             exit(1)
 # end checkprojectoncluster
 
+# cluster_identity works this out once and caches it
 def getnodename():
-    # if /opt/sge/default/common/cluster_name exists, use that
-    try:
-        with open('/opt/sge/default/common/cluster_name', 'r') as f:
-            nodename = f.read().rstrip()
-    except IOError as _:
-        # fall back to getfqdn
-        nodename = socket.getfqdn().casefold()
-    return nodename
+    return cluster_identity.nodename()
 
 def getcluster(nodename):
-    if "thomas" in nodename:
-        return "thomas"
-    elif "michael" in nodename:
-        return "michael"
-    elif "young" in nodename:
-        return "young"
-    else:
+    cluster = cluster_identity.matchcluster(nodename)
+    if cluster is None:
         print("Cluster not recognised, nodename is "+nodename, file=sys.stderr)
         exit(1)
+    return cluster
 # end getcluster
 
 # get the correct MMM db to connect to for this cluster
 def getdb(nodename):
-    if "young" in nodename:
-        db = "young"
-    else:
-        db = "thomas"
-    return db
+    return cluster_identity.databasefor(nodename)
 
 #########################
 #                       #
@@ -347,6 +333,34 @@ def transfergold(source_id, source_alloc_id, project_code, description, amount,
     else:
         return subprocess.check_call(transfer_args)
 
+# Make many transfers in one privileged session with transfergold -f.
+# transfers is a list of (source_id, source_alloc_id, project_code, description, amount)
+# tuples. transfergold checks them all before making any. Returns the exit
+# status of each transfer in order, None for any that were not run.
+def transfergold_batch(transfers, args):
+
+    lines = []
+    for source_id, source_alloc_id, project_code, description, amount in transfers:
+        lines.append(" ".join(['-i', str(source_id), '-a', str(source_alloc_id), '-p', project_code, '-t', description, '-g', str(amount)]))
+    transfer_args = ['transfergold', '-f', '-']
+
+    if (args.debug):
+        print("Arguments that would be used:")
+        print(transfer_args)
+        print("With transfers:")
+        print("\n".join(lines))
+        return [None] * len(transfers)
+
+    result = subprocess.run(transfer_args, input="\n".join(lines) + "\n", stdout=subprocess.PIPE, universal_newlines=True)
+    print(result.stdout)
+    # transfergold prints "Transfer N exit status: S" for each transfer it ran
+    statuses = [None] * len(transfers)
+    for line in result.stdout.splitlines():
+        if line.startswith("Transfer ") and " exit status: " in line:
+            number, _, status = line[len("Transfer "):].partition(" exit status: ")
+            statuses[int(number) - 1] = int(status)
+    return statuses
+
 
 def refreshSAFEgold(args):
 
@@ -0,0 +1,127 @@
+"""
+A fixed-size history of node load and the jobs on each node, kept on disk
+as a ring buffer that is memory-mapped rather than read in.
+
+Each sample adds one fixed-width record per job per node: when it was
+taken, the host, the job and its owner, how many slots the job has on the
+node, and the node's processors, load, memory and swap. Once the buffer is
+full the oldest records are overwritten, so it never grows.
+
+The buffer is a directory holding two .npy files:
+  records.npy  the records
+  head.npy     the next position to write to and the number ever written
+Records are written in time order, so the ring is two sorted runs (from
+the head to the end, then from the start to the head) and the records in a
+time window are found by bisecting those, without reading the rest.
+"""
+
+import os
+import sys
+import time
+
+try:
+  import numpy
+  from numpy.lib.format import open_memmap
+except ImportError:
+  sys.stderr.write("Load history needs numpy.\n")
+  sys.exit(8)
+
+
+RECORD = numpy.dtype([ ("time",       "<i8"),
+                       ("hostname",   "S32"),
+                       ("job",        "S16"),
+                       ("owner",      "S16"),
+                       ("slots",      "<i4"),
+                       ("num_proc",   "<f4"),
+                       ("load_avg",   "<f4"),
+                       ("mem_total",  "<f4"),
+                       ("mem_used",   "<f4"),
+                       ("swap_total", "<f4"),
+                       ("swap_used",  "<f4"),
+                     ])
+
+# 100 bytes a record, so about 800MB
+DEFAULT_CAPACITY = 8000000
+
+
+def open_buffer(path, mode="r"):
+  """ Maps the records and the head of an existing buffer. """
+  records = open_memmap(os.path.join(path, "records.npy"), mode=mode)
+  head = open_memmap(os.path.join(path, "head.npy"), mode=mode)
+  if records.dtype != RECORD:
+    sys.stderr.write("Error: %s is not a load history buffer.\n" % path)
+    sys.exit(9)
+  return records, head
+
+def create_buffer(path, capacity=DEFAULT_CAPACITY):
+  """ Makes a new, empty buffer. The records file is sparse until written. """
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  records = open_memmap(os.path.join(path, "records.npy"), mode="w+", dtype=RECORD, shape=(capacity,))
+  head = open_memmap(os.path.join(path, "head.npy"), mode="w+", dtype="<i8", shape=(2,))
+  records.flush()
+  head.flush()
+  return records, head
+
+
+def sample_records(nodes, when=None):
+  """ One record per job per node, with the job's slots on the node counted. """
+  if when is None:
+    when = int(time.time())
+  slots = dict()
+  for node in nodes:
+    for job in node.jobs:
+      key = (node.hostname, job.id)
+      if key in slots:
+        slots[key][1] += 1
+      else:
+        slots[key] = [ (node, job), 1 ]
+
+  records = numpy.zeros(len(slots), dtype=RECORD)
+  for i, ((node, job), count) in enumerate(slots.values()):
+    # Short hostnames fit the fixed width
+    records[i] = (when, node.hostname.split(".")[0], job.id, job.owner, count,
+                  node.num_proc, node.load_avg, node.mem_total, node.mem_used,
+                  node.swap_total, node.swap_used)
+  return records
+
+def append(path, new_records, capacity=DEFAULT_CAPACITY):
+  """ Writes records at the head, wrapping round and over the oldest. """
+  if os.path.exists(os.path.join(path, "records.npy")):
+    records, head = open_buffer(path, "r+")
+  else:
+    records, head = create_buffer(path, capacity)
+
+  # A sample bigger than the whole buffer keeps only its end
+  new_records = new_records[-len(records):]
+  position = int(head[0])
+  first = min(len(new_records), len(records) - position)
+  records[position:position + first] = new_records[:first]
+  records[:len(new_records) - first] = new_records[first:]
+  records.flush()
+
+  # The head moves only once the records are written
+  head[0] = (position + len(new_records)) % len(records)
+  head[1] += len(new_records)
+  head.flush()
+
+
+def since(path, start):
+  """ A copy of the records written at or after start (in seconds since the epoch). """
+  records, head = open_buffer(path)
+  position = int(head[0])
+  # Unwritten records have a time of 0, which sorts before any start
+  older = records[position:]
+  newer = records[:position]
+  return numpy.concatenate([ older[numpy.searchsorted(older["time"], start):],
+                             newer[numpy.searchsorted(newer["time"], start):] ])
+
+def slot_table(records):
+  """ Records as a nodehealth table, with each row weighted by its slots. """
+  table = dict()
+  for name in ["hostname", "job", "owner"]:
+    table[name] = records[name].astype(str).astype(object)
+  for name in ["num_proc", "load_avg", "mem_total", "mem_used", "swap_total", "swap_used"]:
+    table[name] = records[name].astype(float)
+  table["slots"] = records["slots"].astype(float)
+  return table
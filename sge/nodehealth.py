@@ -0,0 +1,198 @@
+"""
+Node-health analysis for findtrouble.
+
+Works on one table of columnar arrays with a row per job slot: the job and
+its owner, and the load, memory and swap of the node the slot is on. Each
+check is a boolean array over the rows, and the fraction of each user's
+and each job's slots that fail it comes from grouped sums with bincount
+rather than per-slot Python lists.
+
+A table can also have a "slots" column of row weights, for rows that each
+stand for several slots (see loadhistory).
+
+Any node records will do as input as long as they have hostname, num_proc,
+load_avg, mem_total, mem_used, swap_total and swap_used attributes and a
+list of jobs with id and owner attributes.
+"""
+
+import sys
+import csv
+import json
+
+try:
+  import numpy
+except ImportError:
+  sys.stderr.write("Node health analysis needs numpy.\n")
+  sys.exit(8)
+
+
+# Default thresholds, all as fractions
+THRESHOLDS = { "memory":      0.9, # memory used / total above which a node is out of memory
+               "load":        1.2, # load / processors above which a node is overloaded
+               "underload":   0.3, # load / processors below which a node is underused
+               "swap":        0.5, # swap used / total above which a node is swapping heavily
+               "probability": 0.5, # fraction of slots on bad nodes needed to report a user or job
+             }
+
+# Check name -> (section heading, how a failing node is described)
+CHECKS = [ ("memory",    "No Mem",       "has run out of memory"),
+           ("load",      "High Load",    "has a load/proc > %(load)f"),
+           ("underload", "Low Load",     "has a load/proc < %(underload).2f"),
+           ("swap",      "Swapping",     "has used more than %(swap).0f%% of its swap"),
+         ]
+
+FIELDS = [ "check", "scope", "key", "owner", "slots", "fraction", "hosts" ]
+
+
+def add_threshold_arguments(parser):
+  """ Adds a --NAME-threshold option for each threshold to an argparse parser. """
+  for name in sorted(THRESHOLDS):
+    parser.add_argument("--%s-threshold" % name, dest=name, type=float, default=THRESHOLDS[name],
+                        help="default %s" % THRESHOLDS[name])
+
+def thresholds_from_args(args):
+  return dict((name, getattr(args, name)) for name in THRESHOLDS)
+
+
+def slot_table(nodes):
+  """ Flattens node records into one row per job slot, as a dict of arrays. """
+  columns = dict((name, list()) for name in
+                 ["hostname", "job", "owner", "num_proc", "load_avg",
+                  "mem_total", "mem_used", "swap_total", "swap_used"])
+  for node in nodes:
+    for job in node.jobs:
+      columns["hostname"].append(node.hostname)
+      columns["job"].append(job.id)
+      columns["owner"].append(job.owner)
+      columns["num_proc"].append(node.num_proc)
+      columns["load_avg"].append(node.load_avg)
+      columns["mem_total"].append(node.mem_total)
+      columns["mem_used"].append(node.mem_used)
+      columns["swap_total"].append(node.swap_total)
+      columns["swap_used"].append(node.swap_used)
+
+  table = dict()
+  for name in ["hostname", "job", "owner"]:
+    table[name] = numpy.array(columns[name], dtype=object)
+  for name in ["num_proc", "load_avg", "mem_total", "mem_used", "swap_total", "swap_used"]:
+    table[name] = numpy.array(columns[name], dtype=float)
+  return table
+
+
+def node_flags(table, thresholds):
+  """ Evaluates every check for every row at once. """
+  # Nodes reporting zero totals can't be out of anything
+  with numpy.errstate(divide="ignore", invalid="ignore"):
+    load = numpy.where(table["num_proc"] > 0, table["load_avg"] / table["num_proc"], numpy.nan)
+    memory = numpy.where(table["mem_total"] > 0, table["mem_used"] / table["mem_total"], 0.0)
+    swap = numpy.where(table["swap_total"] > 0, table["swap_used"] / table["swap_total"], 0.0)
+  return { "memory":    memory > thresholds["memory"],
+           "load":      load > thresholds["load"],
+           "underload": load < thresholds["underload"],
+           "swap":      swap > thresholds["swap"],
+         }
+
+def group(keys):
+  """ Codes for each distinct key, with the keys in order of first appearance.
+  Also returns the first row for each key.
+  """
+  unique, first, codes = numpy.unique(keys, return_index=True, return_inverse=True)
+  order = numpy.argsort(first)
+  # renumber so code 0 is the first key seen
+  rank = numpy.empty(len(order), dtype=int)
+  rank[order] = numpy.arange(len(order))
+  return unique[order], rank[codes.ravel()], first[order]
+
+def memory_hogs(table, out_of_memory):
+  """ Jobs that are the only job on a node that has run out of memory. """
+  if len(table["job"]) == 0:
+    return []
+  hosts, host_codes, _ = group(table["hostname"])
+  jobs, job_codes, _ = group(table["job"])
+  # distinct (host, job) pairs, then the number of jobs on each host
+  pairs = numpy.unique(host_codes * len(jobs) + job_codes)
+  jobs_per_host = numpy.bincount(pairs // len(jobs), minlength=len(hosts))
+
+  hot_host = numpy.zeros(len(hosts), dtype=bool)
+  hot_host[host_codes[out_of_memory]] = True
+  alone = hot_host[host_codes] & (jobs_per_host[host_codes] == 1)
+
+  findings = list()
+  for code in numpy.unique(job_codes[alone]):
+    rows = alone & (job_codes == code)
+    findings.append({ "check": "memory_hog",
+                      "scope": "job",
+                      "key": jobs[code],
+                      "owner": table["owner"][rows][0],
+                      "slots": int(rows.sum()),
+                      "fraction": 1.0,
+                      "hosts": " ".join(sorted(set(table["hostname"][rows]))) })
+  return findings
+
+def analyse(table, thresholds=THRESHOLDS, hogs=True):
+  """ Returns every user and job whose fraction of slots on failing nodes
+  is over the probability threshold, for every check, as a list of dicts.
+  Memory hogs are only found if hogs is set, as they only make sense for
+  a table from a single instant.
+  """
+  findings = list()
+  if len(table["job"]) == 0:
+    return findings
+  flags = node_flags(table, thresholds)
+  weights = table.get("slots")
+
+  for scope, column in [("user", "owner"), ("job", "job")]:
+    keys, codes, first = group(table[column])
+    slots = numpy.bincount(codes, weights=weights, minlength=len(keys))
+    for check, _, _ in CHECKS:
+      failing = flags[check] if weights is None else flags[check] * weights
+      fraction = numpy.bincount(codes, weights=failing, minlength=len(keys)) / slots
+      for code in numpy.nonzero(fraction > thresholds["probability"])[0]:
+        findings.append({ "check": check,
+                          "scope": scope,
+                          "key": keys[code],
+                          "owner": table["owner"][first[code]],
+                          "slots": int(slots[code]),
+                          "fraction": float(fraction[code]),
+                          "hosts": "" })
+
+  if hogs:
+    findings.extend(memory_hogs(table, flags["memory"]))
+  return findings
+
+
+def print_text(findings, thresholds=THRESHOLDS):
+  """ The per-user report findtrouble has always printed, plus memory hogs. """
+  for i, (check, heading, description) in enumerate(CHECKS):
+    if i > 0:
+      print("")
+    print("--%s--" % heading)
+    for finding in findings:
+      if finding["check"] == check and finding["scope"] == "user":
+        print("%s's %3d jobs have a %6.2f%% chance of being on a node that %s" %
+                (finding["key"], finding["slots"], 100*finding["fraction"],
+                 description % dict(thresholds, swap=100*thresholds["swap"])))
+
+  print("\n--Memory Hogs--")
+  for finding in findings:
+    if finding["check"] == "memory_hog":
+      print("%s's job %s is alone on out of memory node(s): %s" %
+              (finding["owner"], finding["key"], finding["hosts"]))
+
+def write_json(findings, stream=sys.stdout):
+  json.dump(findings, stream, indent=1, sort_keys=True)
+  stream.write("\n")
+
+def write_csv(findings, stream=sys.stdout):
+  writer = csv.writer(stream)
+  writer.writerow(FIELDS)
+  for finding in findings:
+    writer.writerow([finding[field] for field in FIELDS])
+
+def report(findings, output_format="text", thresholds=THRESHOLDS):
+  if output_format == "json":
+    write_json(findings)
+  elif output_format == "csv":
+    write_csv(findings)
+  else:
+    print_text(findings, thresholds)
@@ -0,0 +1,323 @@
+"""
+Shared parsing for SGE XML output (qhost -xml -j and qstat -xml).
+
+The XML is read incrementally with iterparse straight from the command's
+pipe, and each host or job element is cleared once it has been turned
+into a record, so memory stays bounded however large the cluster is and
+records are available while the command is still writing.
+
+By default the output comes from the shared snapshots kept by sgesnapshot
+rather than from qmaster, see snapshot_command.
+"""
+
+import sys
+import os
+import subprocess
+import tempfile
+
+# Covers 2.4-2.5 (where elementtree is in elementtree) to 2.6+ (where it is not)
+try:
+  import lxml.etree as ET
+except ImportError:
+  try:
+    import elementtree.ElementTree as ET
+  except ImportError:
+    try:
+      import xml.etree.ElementTree as ET
+    except ImportError:
+      sys.stderr.write("Could not get an elementtree implementation.\n")
+      sys.exit(8)
+
+# sgesnapshot lives alongside this module
+SNAPSHOT_COMMAND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sgesnapshot")
+
+
+def parse_error(qstat_cmd, stdout, stderr):
+  """ Handles and prints information on XML parsing failures. """
+  sys.stderr.write("No information or failed to parse output.\n")
+  sys.stderr.write("Command executed was: \"%s\"\n" % qstat_cmd)
+  sys.stderr.write("Error is:\n%s\n" % stderr)
+  sys.stderr.write("\n")
+  sys.exit(1)
+
+
+# Output example for one host
+"""
+ <host name='node-u32.data.legion.ucl.ac.uk'>
+   <hostvalue name='arch_string'>lx26-amd64</hostvalue>
+   <hostvalue name='num_proc'>16</hostvalue>
+   <hostvalue name='load_avg'>10.43</hostvalue>
+   <hostvalue name='mem_total'>63.0G</hostvalue>
+   <hostvalue name='mem_used'>9.2G</hostvalue>
+   <hostvalue name='swap_total'>1851.6G</hostvalue>
+   <hostvalue name='swap_used'>909.7M</hostvalue>
+   <job name='5924228'>
+     <jobvalue jobid='5924228' name='priority'>'2.093750'</jobvalue>
+     <jobvalue jobid='5924228' name='qinstance_name'>Ulm@node-u32.data.legion.ucl.ac.uk</jobvalue>
+     <jobvalue jobid='5924228' name='job_name'>CePydPym_INIT</jobvalue>
+     <jobvalue jobid='5924228' name='job_owner'>uccahu0</jobvalue>
+     <jobvalue jobid='5924228' name='job_state'>r</jobvalue>
+     <jobvalue jobid='5924228' name='start_time'>1428476907</jobvalue>
+     <jobvalue jobid='5924228' name='queue_name'>Ulm@node-u32.data.legion.ucl.ac.uk</jobvalue>
+     <jobvalue jobid='5924228' name='pe_master'>SLAVE</jobvalue>
+   </job>
+ </host>
+"""
+
+def deSI(value):
+  """ Converts an SGE MEMORY type (number + SI-ish suffix) to a float """
+  SI_prefixes = { "K": 1000,
+                  "M": 1000*1000,
+                  "G": 1000*1000*1000,
+                  "T": 1000*1000*1000*1000,
+                  }
+  if isinstance(value, int):
+    return value
+  if len(value) == 0:
+    raise TypeError
+
+  if len(value) < 2:
+    if value.isdigit():
+      return int(value)
+    else:
+      if value == "-":
+        return float("nan")
+      raise TypeError(value)
+
+  if value[-1] in SI_prefixes:
+    return float(value[:-2]) * SI_prefixes[value[-1]]
+  else:
+    if value[-1].isdigit() or value[-1] == ".":
+      return float(value)
+    else:
+      raise TypeError
+
+def dequote(value):
+  """ Just removes surrounding single-quote characters,
+  because for some reason, the priority comes wrapped in single-quotes
+  """
+  if len(value) > 2:
+    if value[0] == "'":
+      if value[-1] == "'":
+        return value[1:-2]
+      else:
+        raise TypeError(value)
+    else:
+      raise TypeError(value)
+  else:
+    raise TypeError(value)
+
+class Node:
+  """ Storage class for per-node load values. """
+  def __init__(self):
+    self.hostname   = ""
+    self.num_proc   = 0
+    self.load_avg   = 0
+    self.mem_total  = 0
+    self.mem_used   = 0
+    self.swap_total = 0
+    self.swap_used  = 0
+    self.m_thread   = "-"
+    self.m_core     = "-"
+    self.threads_per_core = 1
+    self.jobs       = list()
+    self.unresponsive = False
+    self.offline    = False
+    # Any host value was "-", eg. the node is down
+    self.missing_values = False
+
+  def fix_types(self):
+    self.hostname   = str(self.hostname)
+    if self.load_avg == "-" or self.mem_used == "-" or self.swap_used == "-":
+      self.unresponsive = True
+    else:
+      self.load_avg   = deSI(self.load_avg)
+      self.mem_used   = deSI(self.mem_used)
+      self.swap_used  = deSI(self.swap_used)
+
+    if self.mem_total == "-" or self.swap_total == "-" or self.num_proc == "-":
+      self.offline = True
+    else:
+      self.mem_total  = deSI(self.mem_total)
+      self.swap_total = deSI(self.swap_total)
+      self.num_proc   = int(self.num_proc)
+
+    if self.m_thread != "-":
+      self.m_thread = int(self.m_thread)
+    if self.m_core != "-":
+      self.m_core = int(self.m_core)
+    if self.m_thread != "-" and self.m_core != "-":
+      self.threads_per_core = self.m_thread / self.m_core
+
+  def __repr__(self):
+    return repr(self.__dict__)
+
+  def print_props(self):
+    if self.unresponsive and not self.offline:
+      sys.stdout.write("    %s:  unresponsive, no data available -- jobs on this node may have failed\n" % self.hostname)
+    elif self.offline:
+      sys.stdout.write("    %s:  offline -- no jobs should be assigned to this node\n" % self.hostname)
+    else:
+      load_partial = "%3.1f %% load" % (100 * float(self.load_avg) / self.num_proc)
+      mem_partial  = "%3.1f %% memory used" % (100 * float(self.mem_used) / self.mem_total)
+      if self.swap_total == 0.0:
+          swap_partial = ""
+      else:
+          swap_partial = ", %3.1f%% swap used" % (100 * float(self.swap_used) / self.swap_total)
+      sys.stdout.write("    %s:  %s, %s%s\n" %
+                       (self.hostname,
+                        load_partial,
+                        mem_partial,
+                        swap_partial
+                       ))
+
+class Job:
+  """ Storage class for per-job information. """
+  def __init__(self):
+    self.name           ="(no name)"
+    self.id             =0
+    self.owner          = "(no owner)"
+    self.state          = "!"
+    self.start_time     = 0
+    self.priority       = 0
+    self.pe_master      = "NO"
+    self.qinstance_name = "(no queue)"
+
+  def fix_types(self):
+    self.name           = str(self.name)
+    self.id             = str(self.id)
+    self.owner          = str(self.owner)
+    self.state          = str(self.state)
+    self.start_time     = int(self.start_time)
+    self.priority       = float(dequote(self.priority))
+    self.pe_master      = str(self.pe_master)
+    self.qinstance_name = str(self.qinstance_name)
+
+  def __repr__(self):
+    return repr(self.__dict__)
+
+class QueuedJob:
+  """ Storage class for one job_list entry from qstat -xml. """
+  def __init__(self):
+    self.id    = ""
+    self.name  = "(no name)"
+    self.owner = "(no owner)"
+    self.state = "!"
+    # The task ids of an array job entry, eg. "1-10:1", or None
+    self.tasks = None
+
+  def __repr__(self):
+    return repr(self.__dict__)
+
+
+job_property_translations = {
+    'job_name': 'name',
+    'job_owner': 'owner',
+    'job_state': 'state',
+    }
+
+def node_from_element(element):
+  """ Convert one qhost host element into a Node (with its list of Jobs). """
+  new_node = Node()
+  new_node.hostname = element.get('name')
+
+  for node_value in element.findall("hostvalue"):
+    new_node.__dict__[node_value.get('name')] = node_value.text
+    if node_value.text == "-":
+      new_node.missing_values = True
+
+  for job_element in element.findall("job"):
+    new_job = Job()
+    new_job.id = job_element.get('name')
+
+    for job_value in job_element.findall("jobvalue"):
+      if job_value.get('name') in job_property_translations:
+        new_job.__dict__[job_property_translations[job_value.get('name')]] = job_value.text
+      else:
+        new_job.__dict__[job_value.get('name')] = job_value.text
+
+    new_job.fix_types()
+    new_node.jobs.append(new_job)
+
+  new_node.fix_types()
+  return new_node
+
+def queued_job_from_element(element):
+  """ Convert one qstat job_list element into a QueuedJob. """
+  new_job = QueuedJob()
+  new_job.id    = element.findtext("JB_job_number")
+  new_job.name  = element.findtext("JB_name")
+  new_job.owner = element.findtext("JB_owner")
+  new_job.state = element.findtext("state")
+  new_job.tasks = element.findtext("tasks")
+  return new_job
+
+
+def iter_elements(source, tag):
+  """ Yields each complete element with this tag from an XML file or
+  file object, then clears it and drops it from the tree.
+  """
+  root = None
+  for event, element in ET.iterparse(source, events=("start", "end")):
+    if root is None:
+      root = element
+    if event == "end" and element.tag == tag:
+      yield element
+      # Everything we want is a child of the root (hosts) or of a
+      # child of the root (job lists), so clearing these is enough
+      element.clear()
+      root.clear()
+
+def iter_nodes(source, prefix="node-"):
+  """ Yields a Node for each host in qhost -xml -j output whose name
+  starts with prefix (which skips the "global" host).
+  """
+  for element in iter_elements(source, "host"):
+    if element.get('name')[0:len(prefix)] == prefix:
+      yield node_from_element(element)
+
+def iter_queued_jobs(source):
+  """ Yields a QueuedJob for each job in qstat -xml output. """
+  for element in iter_elements(source, "job_list"):
+    yield queued_job_from_element(element)
+
+
+def stream_command(cmd, parser):
+  """ Runs an SGE command and yields records from parser(stdout) as the
+  command writes them. Exits with parse_error if the output is bad.
+  """
+  # stderr goes to a file so a chatty command can't block on a full pipe
+  stderr_file = tempfile.TemporaryFile()
+  proc = subprocess.Popen(cmd,
+    shell=True,
+    stdout=subprocess.PIPE,
+    stderr=stderr_file,
+    env=os.environ)
+  try:
+    for record in parser(proc.stdout):
+      yield record
+  except Exception:
+    proc.stdout.close()
+    proc.wait()
+    stderr_file.seek(0)
+    parse_error(cmd, "", stderr_file.read())
+  proc.stdout.close()
+  proc.wait()
+  stderr_file.close()
+
+def snapshot_command(name, live_cmd, live=False):
+  """ The command to get output from: the live command if asked for,
+  otherwise sgesnapshot for the named snapshot (which runs the live
+  command itself if the snapshot is missing or stale).
+  """
+  if live:
+    return live_cmd
+  return "%s %s" % (SNAPSHOT_COMMAND, name)
+
+def stream_file(path, parser):
+  """ Intended to simulate stream_command for debugging. """
+  try:
+    for record in parser(path):
+      yield record
+  except Exception:
+    parse_error("", "", "")
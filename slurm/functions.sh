@@ -10,3 +10,54 @@ function slurm_am_operator() {
             return 1 ;;
     esac
 }
+
+# Sets the jobids array from the given job ids and, if the first argument
+#  isn't empty, the whitespace-separated job ids in that file (- for stdin).
+function slurm_read_jobids() {
+    local jobid_file="$1"
+    shift
+    jobids=("$@")
+    if [[ -n "$jobid_file" ]]; then
+        if [[ "$jobid_file" == "-" ]]; then
+            jobid_file=/dev/stdin
+        fi
+        #shellcheck disable=SC2207
+        # ^-- job ids are whitespace separated
+        jobids+=($(cat "$jobid_file"))
+    fi
+}
+
+# Turns sacct --batch-script or --env-vars output for several jobs into a
+#  tar archive on stdout with a file for each job, named by job id.
+#  Each job's output starts with a line beginning with the given header
+#  prefix, followed by the job id, and then a line of dashes.
+function slurm_sacct_output_to_tar() {
+    local header_prefix="$1"
+    local tmpdir
+    tmpdir="$(mktemp -d)"
+    # shellcheck disable=SC2064
+    # ^-- tmpdir is meant to be expanded now
+    trap "rm -rf '$tmpdir'" RETURN
+    awk -v dir="$tmpdir" -v prefix="$header_prefix" '
+        # A header is only certain once the line of dashes after it is seen
+        header != "" {
+            if ($0 ~ /^-+$/) {
+                if (file != "") { close(file) }
+                file = dir "/" header
+                header = ""
+                next
+            }
+            if (file != "") { print header_line > file }
+            header = ""
+        }
+        index($0, prefix) == 1 {
+            split(substr($0, length(prefix) + 1), parts, " ")
+            header = parts[1]
+            header_line = $0
+            next
+        }
+        file != "" { print > file }
+        END { if (header != "" && file != "") { print header_line > file } }
+    '
+    tar -c -f - -C "$tmpdir" .
+}